@@ -0,0 +1,385 @@
+import re
+
+import numpy as np
+
+from module import Module
+
+
+# Bit positions inside the 20 config bits of a logic cell (see icebox get_lutff_bits)
+LUT_BITS = [4, 14, 15, 5, 6, 16, 17, 7, 3, 13, 12, 2, 1, 11, 10, 0]
+SEQ_BITS = [8, 9, 18, 19]  # CarryEnable, DffEnable, Set_NoReset, AsyncSetReset
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        if parent == x:
+            return x
+        root = self.find(parent)
+        self.parent[x] = root
+        return root
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            self.parent[b] = a
+
+
+def _tile_matrix(tile):
+    return np.frombuffer("".join(tile).encode(), np.uint8).reshape(len(tile), -1) - ord("0")
+
+
+def _compile_db(db):
+    # Config bits of every switch as index/expected-value arrays
+    entries = []
+    for entry in db:
+        if entry[1] not in ["buffer", "routing"]:
+            continue
+        rows, cols, values = [], [], []
+        for bit in entry[0]:
+            m = re.match(r"(!?)B(\d+)\[(\d+)\]", bit)
+            rows.append(int(m.group(2)))
+            cols.append(int(m.group(3)))
+            values.append(0 if m.group(1) else 1)
+        entries.append((np.array(rows), np.array(cols), np.array(values, np.uint8), entry[2], entry[3]))
+    return entries
+
+
+def _flag_bits(db, name):
+    for entry in db:
+        if entry[1] == name:
+            return [(int(m.group(2)), int(m.group(3))) for m in (re.match(r"(!?)B(\d+)\[(\d+)\]", b) for b in entry[0])]
+    return []
+
+
+def _entry_set(mat, bits):
+    for bit in bits:
+        m = re.match(r"(!?)B(\d+)\[(\d+)\]", bit)
+        if mat[int(m.group(2)), int(m.group(3))] != (0 if m.group(1) else 1):
+            return False
+    return True
+
+
+def _lut_expr(bits, inputs):
+    # Shannon expansion on in3..in0, init bit index is in3 in2 in1 in0
+    def build(lo, width, level):
+        if width == 1:
+            return str(bits[lo])
+        half = width // 2
+        low = build(lo, half, level - 1)
+        high = build(lo + half, half, level - 1)
+        if low == high:
+            return low
+        sel = inputs[level]
+        if sel in ["0", "1"]:
+            return high if sel == "1" else low
+        return ("?", sel, high, low)
+
+    return build(0, 16, 3)
+
+
+def vlog_names(filename):
+    # Segments of every net from the "// (x, y, 'wire')" comments of icebox_vlog
+    items = []
+    for line in open(filename):
+        m = re.match(r"\s*// \((\d+), (\d+), '([^']+)'\)", line)
+        if m:
+            items.append((int(m.group(1)), int(m.group(2)), m.group(3)))
+            continue
+        m = re.match(r"\s*(?:input|output|wire|reg)\s+(\w+)", line)
+        if m:
+            items.append(m.group(1))
+    if not any(type(x) is tuple for x in items):
+        raise Exception("%s has no segment comments, run icebox_vlog without -s" % filename)
+
+    # Comments are on the lines around the declaration they belong to
+    if type(items[0]) is not tuple:
+        items = items[::-1]
+    nets = {}
+    segments = []
+    for item in items:
+        if type(item) is tuple:
+            segments.append(item)
+        elif segments:
+            nets[item] = segments
+            segments = []
+    return nets
+
+
+def load_asc(filename, names_from=None):
+    # names_from is icebox_vlog output of the same bitstream, nets then keep
+    # its names. Otherwise they are numbered like icebox_vlog does, by the
+    # sorted segment group of their driver.
+    import icebox
+
+    ic = icebox.iceconfig()
+    ic.read_file(filename)
+
+    uf = UnionFind()
+
+    def key(x, y, name):
+        m = re.match(r"glb_netwk_(\d+)$", name)
+        if m:
+            return ("glb", int(m.group(1)))
+        return (x, y, name)
+
+    tiles = set(ic.logic_tiles) | set(ic.io_tiles) | set(ic.ramb_tiles) | set(ic.ramt_tiles)
+
+    # Wires spanning several tiles
+    groups = sorted(ic.group_segments(tiles, connect_gb=True))
+    for group in groups:
+        first = key(*group[0])
+        for seg in group[1:]:
+            uf.union(first, key(*seg))
+
+    # Active switches, evaluated for all tiles sharing a database at once
+    by_db = {}
+    for xy in sorted(tiles):
+        db = ic.tile_db(*xy)
+        by_db.setdefault(id(db), (db, []))[1].append(xy)
+
+    for db, coords in by_db.values():
+        mats = np.stack([_tile_matrix(ic.tile(*xy)) for xy in coords])
+        for rows, cols, values, src, dst in _compile_db(db):
+            active = np.all(mats[:, rows, cols] == values, axis=1)
+            for i in np.nonzero(active)[0]:
+                x, y = coords[i]
+                uf.union(key(x, y, src), key(x, y, dst))
+
+    # Block RAM is not modelled, any bit besides routing means it is in use
+    for xy in sorted(set(ic.ramb_tiles) | set(ic.ramt_tiles)):
+        mat = _tile_matrix(ic.tile(*xy))
+        routing = np.zeros(mat.shape, bool)
+        for entry in ic.tile_db(*xy):
+            if entry[1] in ["buffer", "routing", "ColBufCtrl"]:
+                for bit in entry[0]:
+                    m = re.match(r"!?B(\d+)\[(\d+)\]", bit)
+                    routing[int(m.group(1)), int(m.group(2))] = True
+        if (mat.astype(bool) & ~routing).any() or any(int(x, 16) for x in ic.ram_data.get(xy, [])):
+            raise Exception("%d %d: block RAM is not supported" % xy)
+
+    # Pads only as plain wires, PIN_TYPE bit 0 is a direct input and bits
+    # 5..2 either no output or a direct output
+    pin_types = {}
+    for xy in sorted(ic.io_tiles):
+        mat = _tile_matrix(ic.tile(*xy))
+        for entry in ic.tile_db(*xy):
+            if entry[1].startswith("PLL") or entry[-1].startswith("PLLCONFIG_"):
+                if _entry_set(mat, entry[0]):
+                    raise Exception("%d %d: PLLs are not supported" % xy)
+            m = re.match(r"IOB_(\d+)$", entry[1])
+            if m and entry[2].startswith("PINTYPE_") and _entry_set(mat, entry[0]):
+                z = int(m.group(1))
+                pin_types[xy + (z,)] = pin_types.get(xy + (z,), 0) | 1 << int(entry[2][8:])
+    for (x, y, z), pin_type in sorted(pin_types.items()):
+        if pin_type >> 2 not in [0b0000, 0b0110]:
+            raise Exception("%d %d io_%d: PIN_TYPE %s is not supported" % (x, y, z, format(pin_type, "06b")))
+
+    # Global networks driven straight from pads
+    extra_db = ic.extra_bits_db()
+    padin = ic.padin_pio_db()
+    for bit in ic.extra_bits:
+        func = extra_db.get(bit)
+        if not func or func[0] != "padin_glb_netwk":
+            raise Exception("extra bit %s %s is not supported" % (bit, func))
+        x, y, z = padin[int(func[1])]
+        uf.union(("glb", int(func[1])), (x, y, "io_%d/D_IN_0" % z))
+
+    for xy in ic.logic_tiles:
+        if xy[1] > 0 and (xy[0], xy[1] - 1) in ic.logic_tiles:
+            uf.union((xy[0], xy[1] - 1, "lutff_7/cout"), (xy[0], xy[1], "carry_in"))
+
+    # Decode every logic cell of every logic tile in one go
+    coords = sorted(ic.logic_tiles)
+    mats = np.stack([_tile_matrix(ic.logic_tiles[xy]) for xy in coords])
+    cells = mats[:, :, 36:46].reshape(len(coords), 8, 20)
+    luts = cells[:, :, LUT_BITS]
+    seqs = cells[:, :, SEQ_BITS].astype(bool)
+    used = luts.any(axis=2) | seqs[:, :, 0] | seqs[:, :, 1]
+
+    logic_db = ic.tile_db(*coords[0]) if coords else []
+    carry_set = _flag_bits(logic_db, "CarryInSet")
+    neg_clk = _flag_bits(logic_db, "NegClk")
+
+    # Driven nets and the segment driving them
+    drivers = {}
+    for t, i in zip(*np.nonzero(used)):
+        x, y = coords[t]
+        segs = ["lutff_%d/out" % i, "lutff_%d/lout" % i] + (["lutff_%d/cout" % i] if seqs[t, i, 0] else [])
+        for seg in segs:
+            drivers.setdefault(uf.find((x, y, seg)), (x, y, seg))
+
+    names = {}
+    for (x, y) in sorted(ic.io_tiles):
+        for z in range(2):
+            root = uf.find((x, y, "io_%d/D_IN_0" % z))
+            drivers.setdefault(root, (x, y, "io_%d/D_IN_0" % z))
+            names.setdefault(root, "io_%d_%d_%d" % (x, y, z))
+    pads = set(names.values())
+
+    taken = set()
+    if names_from:
+        vlog = vlog_names(names_from)
+        taken.update(vlog)
+        for name, segs in vlog.items():
+            for seg in segs:
+                root = uf.find(key(*seg))
+                if drivers.get(root) == seg:
+                    names.setdefault(root, name)
+    else:
+        group_names = {}
+        count = 0
+        for group in groups:
+            if uf.find(key(*group[0])) in drivers:
+                count += 1
+                for seg in group:
+                    group_names[seg] = "n%d" % count
+        for root, seg in drivers.items():
+            if seg in group_names:
+                names.setdefault(root, group_names[seg])
+
+    # Nets local to a tile (carry chains) are numbered when first used
+    taken.update(names.values())
+    counter = [len(groups)]
+
+    referenced = set()
+
+    def net(x, y, name):
+        root = uf.find(key(x, y, name))
+        if root not in names:
+            if root not in drivers:
+                return "0"
+            while "n%d" % counter[0] in taken:
+                counter[0] += 1
+            names[root] = "n%d" % counter[0]
+            taken.add(names[root])
+        referenced.add(names[root])
+        return names[root]
+
+    mod = Module([], [])
+
+    for t, i in zip(*np.nonzero(used)):
+        x, y = coords[t]
+        lc = "lutff_%d" % i
+        inputs = [net(x, y, "%s/in_%d" % (lc, j)) for j in range(4)]
+        lut = _lut_expr(luts[t, i], inputs)
+        carry_enable, dff_enable, set_noreset, async_sr = seqs[t, i]
+
+        out = net(x, y, lc + "/out")
+        lout = net(x, y, lc + "/lout")
+
+        if carry_enable:
+            if i == 0:
+                cin = net(x, y, "carry_in_mux")
+                if cin == "0" and carry_set and all(mats[t, r, c] for r, c in carry_set):
+                    cin = "1"
+            else:
+                cin = net(x, y, "lutff_%d/cout" % (i - 1))
+            cout = net(x, y, lc + "/cout")
+            if cout != "0":
+                mod.add_assignment(cout, ("carry", inputs[1], inputs[2], cin))
+
+        if dff_enable:
+            if neg_clk and all(mats[t, r, c] for r, c in neg_clk):
+                raise Exception("%d %d %s: negative edge clocks are not supported" % (x, y, lc))
+            if async_sr:
+                raise Exception("%d %d %s: asynchronous set/reset is not supported" % (x, y, lc))
+
+            clk = net(x, y, "lutff_global/clk")
+            cen = net(x, y, "lutff_global/cen")
+            sr = net(x, y, "lutff_global/s_r")
+            value = lut
+            if sr != "0":
+                value = ("?", sr, "1" if set_noreset else "0", lut)
+
+            if out != "0":
+                mod.add_register(out, "0")
+                mod.add_clocked(clk, "1" if cen == "0" else cen, out, value)
+            if lout != "0":
+                mod.add_assignment(lout, lut)
+        else:
+            if out != "0":
+                mod.add_assignment(out, lut)
+            if lout != "0" and lout != out:
+                mod.add_assignment(lout, lut)
+
+    for (x, y) in ic.io_tiles:
+        for z in range(2):
+            driver = net(x, y, "io_%d/D_OUT_0" % z)
+            name = "io_%d_%d_%d" % (x, y, z)
+            if driver != "0" and driver != name:
+                mod.outputs.append(name)
+                mod.add_assignment(name, driver)
+
+    mod.inputs = sorted(referenced & pads)
+    for (x, y) in sorted(ic.io_tiles):
+        for z in range(2):
+            pin_type = pin_types.get((x, y, z), 0)
+            if "io_%d_%d_%d" % (x, y, z) in mod.inputs and pin_type & 3 != 1:
+                raise Exception("%d %d io_%d: PIN_TYPE %s is not supported" % (x, y, z, format(pin_type, "06b")))
+    return mod
+
+
+def main():
+    import argparse
+    import random
+    import sys
+    from contextlib import redirect_stdout
+
+    from cleanup3 import Cleaner
+    from sim import Simulator
+
+    parser = argparse.ArgumentParser(description="Check that an .asc imports the same as its icebox_vlog output")
+    parser.add_argument("asc", nargs="?", default="test.asc")
+    parser.add_argument("vlog", nargs="?", default="test.v", help="icebox_vlog output of the same .asc, with comments")
+    parser.add_argument("--names", action="store_true", help="Take the net names from the Verilog")
+    parser.add_argument("--cycles", type=int, default=10000)
+    args = parser.parse_args()
+
+    with redirect_stdout(sys.stderr):
+        a = Cleaner(mod=load_asc(args.asc, args.vlog if args.names else None))
+        b = Cleaner.load(args.vlog)
+        a.clean()
+        b.clean()
+
+    ok = True
+    for what in ["inputs", "outputs"]:
+        x, y = sorted(getattr(a.mod, what)), sorted(getattr(b.mod, what))
+        if x != y:
+            print("%s differ: %s vs %s" % (what, x, y))
+            ok = False
+
+    missing = set(b.mod.combinatorial) | set(x.dest for x in b.mod.clocked)
+    missing -= set(a.mod.combinatorial) | set(x.dest for x in a.mod.clocked)
+    if missing:
+        print("%d nets of %s are not in %s, e.g. %s" % (len(missing), args.vlog, args.asc, " ".join(sorted(missing)[:10])))
+        ok = False
+    print("format: %s" % ("same" if a.format() == b.format() else "differs"))
+
+    sims = [Simulator(a.mod), Simulator(b.mod)]
+    inputs = [x for x in a.mod.inputs if x in b.mod.inputs and x != sims[0].clock]
+    random.seed(0)
+    matched = True
+    for cycle in range(args.cycles):
+        values = {net: random.randint(0, 1) for net in inputs}
+        for sim in sims:
+            for net, value in values.items():
+                sim.set(net, value)
+            sim.propagate()
+        diff = [net for net in a.mod.outputs if net in b.mod.outputs and sims[0].get(net) != sims[1].get(net)]
+        if diff:
+            print("cycle %d: %s differ" % (cycle, " ".join(diff)))
+            matched = False
+            break
+        for sim in sims:
+            sim.step()
+    print("simulation: %s" % ("%d cycles match" % args.cycles if matched else "mismatch"))
+    sys.exit(0 if ok and matched else 1)
+
+
+if __name__ == "__main__":
+    main()
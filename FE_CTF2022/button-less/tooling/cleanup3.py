@@ -2,14 +2,20 @@
 import numpy as np
 import json
 import tempfile
+import time
 import os
 import re
+import sys
 import typing
 from pyverilog.ast_code_generator.codegen import ASTCodeGenerator
 from pyverilog.vparser import parser
 
-from expr import assemble, in_op, match_op, optimize, without
-from module import Module, ClockedExpr
+import egraph
+import scan
+from asc import load_asc
+from expr import OPTIMIZER, assemble, in_op, match_op, optimize, without
+from module import Module, ClockedExpr, _expr_nets
+from passes import DEFAULT_PIPELINE, PassManager, declare
 
 
 operator_mark = {
@@ -37,7 +43,24 @@ def op2mark(op):
 
 
 class Cleaner:
-    def __init__(self, lines: typing.List[str]):
+    def __init__(self, lines: typing.List[str] = None, mod: Module = None, rules: dict = None):
+        if mod is not None:
+            self.mod = mod
+        else:
+            self._parse(lines)
+
+        if rules is None:
+            rules = json.loads(open("cleanup_renames.json", "r").read())
+        self.rules = rules
+
+    @classmethod
+    def load(cls, source, names_from=None):
+        if source.endswith(".asc"):
+            return cls(mod=load_asc(source, names_from))
+        with open(source, "r") as f:
+            return cls(f.readlines())
+
+    def _parse(self, lines: typing.List[str]):
         tmp = tempfile.NamedTemporaryFile("w")
         for l in lines:
             l = re.sub(r"^(.*)/\*\s*CARRY.+\*/", r"(* CARRY *)\1", l)
@@ -140,28 +163,54 @@ class Cleaner:
         gen = ASTCodeGenerator()
         visit(ast)
 
-        self.rules = json.loads(open("cleanup_renames.json", "r").read())
+    def format(self, nets=None):
+        combinatorial = self.mod.combinatorial
+        clocked = self.mod.clocked
+        bundles = self.mod.bundles
+        inputs = self.mod.inputs
+        outputs = self.mod.outputs
+
+        if nets is not None:
+            # Subset of the design, undriven nets become inputs
+            nets = set(nets)
+            combinatorial = {k: v for k, v in combinatorial.items() if k in nets}
+            clocked = [x for x in clocked if x.dest in nets]
+            bundles = {k: v for k, v in bundles.items() if all(x in nets for x in v)}
+
+            driven = set(combinatorial) | set(x.dest for x in clocked)
+            used = set()
+            for net in driven:
+                used |= self.mod.fanin(net)
+            used |= set(x.clock for x in clocked)
+
+            inputs = sorted(used - driven)
+            outputs = [x for x in outputs if x in driven]
 
-    def format(self):
         f = []
-        f.append("module top(%s);" % ", ".join([", ".join(["input " + x for x in self.mod.inputs]), ", ".join(["output " + x for x in self.mod.outputs])]))
+        f.append("module top(%s);" % ", ".join(filter(None, [", ".join(["input " + x for x in inputs]), ", ".join(["output " + x for x in outputs])])))
         f.append("function carry(input a, input b, input c); carry = (a&b) | ((a|b) & c); endfunction")
         f.append("function fa(input a, input b, input c); fa = a^b^c; endfunction")
 
-        for comb in self.mod.combinatorial:
-            f.append("wire %s;" % comb)
+        for comb in combinatorial:
+            if comb in self.mod.widths:
+                f.append("wire [%d:0] %s;" % (self.mod.widths[comb]-1, comb))
+            else:
+                f.append("wire %s;" % comb)
 
-        for proc in self.mod.clocked:
-            f.append("reg %s = %s;" % (proc.dest, proc.init))
+        for proc in clocked:
+            if proc.width > 1:
+                f.append("reg [%d:0] %s = %s;" % (proc.width-1, proc.dest, proc.init))
+            else:
+                f.append("reg %s = %s;" % (proc.dest, proc.init))
 
-        for name, nets in self.mod.bundles.items():
-            f.append("wire [%d-1:0] %s = {%s};" % (len(nets), name, ",".join(nets)))
+        for name, bundle in bundles.items():
+            f.append("wire [%d-1:0] %s = {%s};" % (len(bundle), name, ",".join(bundle)))
 
-        for net, expr in self.mod.combinatorial.items():
+        for net, expr in combinatorial.items():
             f.append("assign %s = %s;" % (net, assemble(expr)))
 
         clks = {}
-        for proc in self.mod.clocked:
+        for proc in clocked:
             if proc.clock not in clks:
                 clks[proc.clock] = {
                     "no_ce": [],
@@ -224,6 +273,7 @@ class Cleaner:
         f.append("endmodule")
         return "\n".join(f)
 
+    @declare(reads=["combinatorial", "clocked"], writes=["combinatorial", "clocked"])
     def _pass_wire_forward(self):
         def is_simple(w):
             if type(w) is str:
@@ -239,6 +289,7 @@ class Cleaner:
 
         return replaced
 
+    @declare(reads=["combinatorial", "clocked"], writes=["combinatorial", "clocked"])
     def _pass_optimize(self):
         for net, expr in self.mod.combinatorial.items():
             self.mod.combinatorial[net] = optimize(expr)
@@ -247,35 +298,28 @@ class Cleaner:
             proc.ce = optimize(proc.ce)
             proc.value = optimize(proc.value)
 
+    @declare(reads=["combinatorial", "clocked", "outputs"], writes=["combinatorial"], idempotent=True)
     def _pass_unused(self):
         removed = 0
-        for net in list(self.mod.combinatorial):
-            if not self.mod.is_used(net):
-                del self.mod.combinatorial[net]
+        fanout = self.mod.fanout_index()
+        work = list(self.mod.combinatorial)
+        while work:
+            net = work.pop()
+            if net in self.mod.combinatorial and net not in self.mod.outputs and not fanout.get(net):
+                expr = self.mod.combinatorial.pop(net)
+                removed += 1
+                for src in _expr_nets(expr):
+                    fanout[src].discard(net)
+                    work.append(src)
 
         return removed
 
+    @declare(reads=["rules:rename", "combinatorial", "clocked", "inputs", "outputs", "widths"], writes=["combinatorial", "clocked", "inputs", "outputs", "widths"], idempotent=True, when="rename")
     def _pass_rename(self):
         for prev, new in self.rules["rename"].items():
-            self.mod.replace_net(prev, new)
-            
-            if prev in self.mod.inputs:
-                self.mod.inputs[self.mod.inputs.index(prev)] = new
-            if prev in self.mod.outputs:
-                self.mod.outputs[self.mod.outputs.index(prev)] = new
-
-            if prev in self.mod.combinatorial:
-                val = self.mod.combinatorial[prev]
-                del self.mod.combinatorial[prev]
-                self.mod.combinatorial[new] = val
-            
-            for proc in self.mod.clocked:
-                if proc.clock == prev:
-                    proc.clock = new
-                if proc.dest == prev:
-                    proc.dest = new
-                    break
+            self.mod.rename_net(prev, new)
 
+    @declare(reads=["rules:resets", "combinatorial", "clocked"], writes=["combinatorial", "clocked"], when="resets")
     def _pass_ff_reset_propagate(self):
         for rst, pol in self.rules["resets"].items():
             if pol != "0":
@@ -286,6 +330,7 @@ class Cleaner:
                     self.mod.combinatorial[comb] = optimize(without(expr, rst))
                     self.mod.replace_net(comb, ("&", comb, rst))
 
+    @declare(reads=["rules:resets", "clocked"], writes=["clocked"], idempotent=True, when="resets")
     def _pass_ff_promote_resets(self):
         for rst, pol in self.rules["resets"].items():
             if pol != "0":
@@ -315,6 +360,7 @@ class Cleaner:
         self.mod.replace_net(name, ("!", name))
         proc.value = optimize(("!", proc.value))
 
+    @declare(reads=["combinatorial"], writes=["combinatorial"], idempotent=True)
     def _pass_carry_full_adder(self):
         def is_sum0(netname, sources):
             expr = self.mod.combinatorial[netname]
@@ -366,10 +412,12 @@ class Cleaner:
                                 self.mod.combinatorial[usage] = ("fa",) + tuple(comb[1:])
                                 break
 
+    @declare(reads=["rules:invert_ff", "combinatorial", "clocked"], writes=["combinatorial", "clocked"], when="invert_ff")
     def _pass_invert_ffs(self):
         for net in self.rules["invert_ff"]:
             self._invert_ff(net)
 
+    @declare(reads=["rules:trace_shifts", "clocked"], idempotent=True, when="trace_shifts")
     def _pass_trace_shifts(self):
         for net in self.rules["trace_shifts"]:
             src = self.mod.find_ff(net)
@@ -394,18 +442,8 @@ class Cleaner:
 
                 src = inp
 
+    @declare(reads=["rules:align_shifts", "combinatorial", "clocked"], writes=["combinatorial", "clocked"], when="align_shifts")
     def _pass_align_shifts(self):
-        def decode(inv, order, bits):
-            chars = len(bits) // 8
-            b = np.array(bits[0:chars*8], np.uint8).reshape((-1, 8))
-            if order:
-                b = np.flip(b, axis=1)
-            if inv:
-                b ^= 1
-            b = np.packbits(b.reshape((-1)), bitorder="little")
-            s = bytes(b).decode("ascii", errors="ignore")
-            return "'%s' '%s'" % (s, s[::-1])
-
         for net in self.rules["align_shifts"]:
             src = self.mod.find_ff(net)
             if not src:
@@ -434,67 +472,246 @@ class Cleaner:
                 src = inp
             
             print("%s: %s" % (net, "".join(bits)))
-            for inv in [0, 1]:
-                for order in [0, 1]:
-                    print(" %d,%d: %s" % (inv, order, decode(inv, order, bits)))
-
+            for r in scan.scan_bits([np.array([b == "1" for b in bits], np.uint8)], top=4, min_chars=1):
+                r["chain"] = net
+                print(" " + scan.format_result(r))
+
+    @declare(reads=["rules:scan_strings", "clocked"], idempotent=True, when="scan_strings")
+    def _pass_scan_strings(self):
+        config = self.rules["scan_strings"]
+        if type(config) is not dict:
+            config = {}
+
+        results = scan.scan_module(
+            self.mod,
+            top=config.get("top", 20),
+            min_chars=config.get("min_chars", 4),
+            min_length=config.get("min_length", 8))
+
+        for r in results:
+            print("%s %s len %d" % (scan.format_result(r), r["source"], r["length"]))
+
+    @declare(reads=["rules:output", "outputs"], writes=["outputs"], when="output")
     def _pass_output(self):
         for net in self.rules["output"]:
             self.mod.outputs.append(net)
 
+    @declare(reads=["combinatorial", "clocked"], writes=["combinatorial", "clocked"], idempotent=True)
     def _pass_align_carrys(self):
         for net, expr in self.mod.combinatorial.items():
             if match_op(expr, "carry") and match_op(expr[1], "!") and self.mod.find_ff(expr[1][1]):
                 self._invert_ff(expr[1][1])
 
+    @declare(reads=["combinatorial", "clocked", "widths"], writes=["combinatorial", "clocked", "widths"])
+    def _pass_word_ops(self):
+        comb = self.mod.combinatorial
+
+        def const_word(width, bits):
+            return "%d'd%d" % (width, sum(int(b == "1") << i for i, b in enumerate(bits)))
+
+        def fold_cin(width, bits, cin):
+            value = sum(int(b == "1") << i for i, b in enumerate(bits))
+            if cin in ["0", "1"]:
+                value += int(cin)
+                # All ones plus carry in only fits with the carry out bit
+                return ("%d'd%d" % (max(width, value.bit_length()), value),)
+            return ("%d'd%d" % (width, value), cin)
+
+        def find_top(carry_net):
+            for usage in self.mod.find_uses([carry_net]):
+                expr = comb[usage]
+                neg = match_op(expr, "!")
+                if neg:
+                    expr = expr[1]
+                if match_op(expr, "^") and len(expr) == 3 and in_op(expr, carry_net):
+                    other = without(expr, carry_net)
+                    if len(other) == 2:
+                        return usage, other[1], "1" if neg else "0"
+            return None
+
+        carries = {net: expr for net, expr in comb.items() if match_op(expr, "carry")}
+        sums = {expr[1:]: net for net, expr in comb.items() if match_op(expr, "fa")}
+
+        next_carry = {}
+        for net, expr in carries.items():
+            if expr[3] in carries:
+                next_carry.setdefault(expr[3], []).append(net)
+
+        for start, expr in carries.items():
+            if expr[3] in carries:
+                continue
+
+            chain = [start]
+            while len(next_carry.get(chain[-1], [])) == 1:
+                chain.append(next_carry[chain[-1]][0])
+            if len(chain) < 2:
+                continue
+
+            a = [carries[x][1] for x in chain]
+            b = [carries[x][2] for x in chain]
+            s = [sums.get(carries[x][1:]) for x in chain]
+            cout = chain[-1]
+            cin = expr[3]
+
+            top = find_top(cout)
+            if top:
+                s.append(top[0])
+                a.append(top[1])
+                b.append(top[2])
+                cout = None
+
+            width = len(a)
+            const_b = all(x in ["0", "1"] for x in b)
+
+            # Counter: every bit is an FF loading its own sum
+            procs = [self.mod.find_ff(x) if type(x) is str else None for x in a]
+            ca, cb, cs, ccin = a, b, s, cin
+            # yosys starts the chain at bit 1, carrying in from a toggling bit 0
+            lsb = self.mod.find_ff(cin) if type(cin) is str else None
+            if lsb and lsb.width == 1 and lsb.value == ("!", cin) and cin not in a:
+                ca, cb, cs, ccin = [cin] + a, ["0"] + b, [None] + s, "1"
+                procs = [lsb] + procs
+
+            def loads(i, p, n):
+                if n:
+                    return p.value == n
+                # optimize folds a constant carry in into bit 0, a0 ^ b0 ^ cin
+                if i != 0 or ccin not in ["0", "1"]:
+                    return False
+                return p.value == (ca[0] if cb[0] == ccin else ("!", ca[0]))
+
+            if const_b and all(procs) and all(loads(i, p, n) for i, (p, n) in enumerate(zip(procs, cs))):
+                first = procs[0]
+                same = all((p.clock, p.ce, p.reset, p.ce_reset) == (first.clock, first.ce, first.reset, first.ce_reset) for p in procs)
+                if same and ccin not in ca:
+                    width = len(ca)
+                    name = "cnt_" + ca[0]
+                    proc = ClockedExpr(first.clock, first.ce, name, ("+", name) + fold_cin(width, cb, ccin), const_word(width, [p.reset_value for p in procs]), width)
+                    proc.init = const_word(width, [p.init for p in procs])
+                    proc.reset = first.reset
+                    proc.ce_reset = first.ce_reset
+
+                    for i, p in enumerate(procs):
+                        self.mod.clocked.remove(p)
+                        comb[p.dest] = ("[]", name, str(i))
+                    self.mod.clocked.append(proc)
+                    continue
+
+            operand = ("cat",) + tuple(reversed(a))
+
+            # Comparator: only the carry out is used
+            if not any(s) and const_b and cin in ["0", "1"]:
+                limit = (1 << width) - sum(int(x == "1") << i for i, x in enumerate(b)) - int(cin)
+                if limit <= 0:
+                    comb[cout] = "1"
+                elif limit >= (1 << width):
+                    comb[cout] = "0"
+                else:
+                    comb[cout] = ("<", "%d'd%d" % (width, limit - 1), operand)
+                continue
+
+            if not any(s):
+                continue
+
+            # Adder: sum bits (and carry out) become slices of one vector
+            name = "add_" + start
+            if const_b:
+                comb[name] = ("+", operand) + fold_cin(width, b, cin)
+            else:
+                comb[name] = ("+", operand, ("cat",) + tuple(reversed(b))) + ((cin,) if cin != "0" else ())
+            self.mod.widths[name] = width + (1 if cout else 0)
+
+            for i, net in enumerate(s):
+                if net:
+                    comb[net] = ("[]", name, str(i))
+            if cout:
+                comb[cout] = ("[]", name, str(width))
+
+        # Equality against a constant: & over literals of the bits of one word
+        bits = {net: expr[1:] for net, expr in comb.items() if match_op(expr, "[]")}
+        widths = dict(self.mod.widths)
+        widths.update({proc.dest: proc.width for proc in self.mod.clocked if proc.width > 1})
+
+        def compare(expr):
+            if type(expr) is not tuple:
+                return expr
+            expr = (expr[0],) + tuple(map(compare, expr[1:]))
+            if not match_op(expr, "&") or len(expr) < 3:
+                return expr
+
+            lits = []
+            for x in expr[1:]:
+                pol = "1"
+                if match_op(x, "!"):
+                    x = x[1]
+                    pol = "0"
+                if type(x) is not str or x not in bits:
+                    return expr
+                lits.append((int(bits[x][1]), x, pol))
+
+            words = set(bits[x][0] for _, x, _ in lits)
+            if len(words) != 1 or len(set(i for i, _, _ in lits)) != len(lits):
+                return expr
+
+            lits.sort(reverse=True)
+            word = words.pop()
+            if len(lits) == widths.get(word):
+                return ("==", word, const_word(len(lits), [pol for _, _, pol in reversed(lits)]))
+            return ("==", ("cat",) + tuple(x for _, x, _ in lits), const_word(len(lits), [pol for _, _, pol in reversed(lits)]))
+
+        for net, expr in comb.items():
+            comb[net] = compare(expr)
+        for proc in self.mod.clocked:
+            proc.ce = compare(proc.ce)
+            proc.value = compare(proc.value)
+
+    @declare(reads=["rules:egraph", "combinatorial", "clocked", "outputs"], writes=["combinatorial", "clocked"], deterministic=False, when="egraph")
+    def _pass_egraph(self):
+        config = self.rules.get("egraph")
+        if config is None:
+            return
+
+        # One budget for the whole pass, nets after it runs out are left alone
+        stats = egraph.optimize_module(
+            self.mod,
+            config.get("nets"),
+            depth=config.get("depth", 0),
+            node_limit=config.get("node_limit", 10000),
+            iter_limit=config.get("iter_limit", 10),
+            deadline=time.perf_counter() + config.get("time_limit", 1.0))
+
+        for net, (before, after) in stats.items():
+            print(f"egraph {net}: {before} -> {after} LUT4")
+        print(f"egraph: {len(stats)} improved, {sum(x[0] for x in stats.values())} -> {sum(x[1] for x in stats.values())} LUT4")
+
+    @declare(reads=["rules:bundle_wires", "bundles"], writes=["bundles"], idempotent=True, when="bundle_wires")
     def _pass_bundle_wires(self):
         for name, bundle in self.rules["bundle_wires"].items():
             self.mod.bundles[name] = bundle
 
+    def run_passes(self, pipeline):
+        PassManager(self).run(pipeline)
+
     def clean(self):
-        self._pass_wire_forward()
-        self._pass_optimize()
-        self._pass_unused()
+        self.run_passes(["clean"])
 
     def pass1(self):
-        self.clean()
-        self.clean()
+        self.run_passes(["pass1"])
 
     def pass2(self):
-        self._pass_rename()
-        self._pass_output()
-        self._pass_ff_reset_propagate()
-        self._pass_ff_promote_resets()
-
-        self.clean()
+        self.run_passes(["pass2"])
 
-        self._pass_carry_full_adder()
-
-        self._pass_invert_ffs()
-        self.clean()
-
-        self._pass_align_shifts()
-        self.clean()
-        self._pass_trace_shifts()
-    
     def pass3(self):
-        self._pass_align_carrys()
-        self.clean()
+        self.run_passes(["pass3"])
 
-        self._pass_bundle_wires()
-        self.clean()
 
+if __name__ == "__main__":
+    cleaner = Cleaner.load(sys.argv[1] if len(sys.argv) > 1 else "test.v", sys.argv[2] if len(sys.argv) > 2 else None)
+    manager = PassManager(cleaner, cleaner.rules.get("pass_cache", "pass_cache.pkl"))
+    manager.run(cleaner.rules.get("pipeline", DEFAULT_PIPELINE))
+    manager.save()
 
-with open("test.v", "r") as f:
-    cleaner = Cleaner(f.readlines())
-    cleaner.pass1()
-    with open("top_clean_pass1.v", "w") as f:
-        f.write(cleaner.format())
-        
-    cleaner.pass2()
-    with open("top_clean_pass2.v", "w") as f:
-        f.write(cleaner.format())
-        
-    cleaner.pass3()
-    with open("top_clean_pass3.v", "w") as f:
-        f.write(cleaner.format())
+    if cleaner.rules.get("rule_stats"):
+        print(OPTIMIZER.report())
+    if cleaner.rules.get("pass_stats"):
+        print(manager.report())
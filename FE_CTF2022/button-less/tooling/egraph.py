@@ -0,0 +1,364 @@
+import time
+
+from expr import RULES, match_op
+from rewrite import is_var
+
+
+LUT_INPUTS = 4
+
+# LUT logic, everything else (carry chains, vector ops) is a separate cell
+LUT_OPS = set(["&", "|", "^", "!", "?", "fa"])
+ASSOCIATIVE = set(["&", "|", "^"])
+
+
+# Identities on the binary form used inside the e-graph
+EGRAPH_RULES = [
+    (("&", "$a", "$b"), ("&", "$b", "$a")),
+    (("|", "$a", "$b"), ("|", "$b", "$a")),
+    (("^", "$a", "$b"), ("^", "$b", "$a")),
+    (("&", "$a", ("&", "$b", "$c")), ("&", ("&", "$a", "$b"), "$c")),
+    (("&", ("&", "$a", "$b"), "$c"), ("&", "$a", ("&", "$b", "$c"))),
+    (("|", "$a", ("|", "$b", "$c")), ("|", ("|", "$a", "$b"), "$c")),
+    (("|", ("|", "$a", "$b"), "$c"), ("|", "$a", ("|", "$b", "$c"))),
+    (("^", "$a", ("^", "$b", "$c")), ("^", ("^", "$a", "$b"), "$c")),
+    (("^", ("^", "$a", "$b"), "$c"), ("^", "$a", ("^", "$b", "$c"))),
+
+    (("&", "$a", "0"), "0"),
+    (("&", "$a", "1"), "$a"),
+    (("|", "$a", "0"), "$a"),
+    (("|", "$a", "1"), "1"),
+    (("^", "$a", "0"), "$a"),
+    (("^", "$a", "1"), ("!", "$a")),
+    (("&", "$a", "$a"), "$a"),
+    (("|", "$a", "$a"), "$a"),
+    (("^", "$a", "$a"), "0"),
+    (("&", "$a", ("!", "$a")), "0"),
+    (("|", "$a", ("!", "$a")), "1"),
+
+    (("!", ("&", "$a", "$b")), ("|", ("!", "$a"), ("!", "$b"))),
+    (("|", ("!", "$a"), ("!", "$b")), ("!", ("&", "$a", "$b"))),
+    (("!", ("|", "$a", "$b")), ("&", ("!", "$a"), ("!", "$b"))),
+    (("&", ("!", "$a"), ("!", "$b")), ("!", ("|", "$a", "$b"))),
+    (("!", ("^", "$a", "$b")), ("^", ("!", "$a"), "$b")),
+    (("^", ("!", "$a"), "$b"), ("!", ("^", "$a", "$b"))),
+
+    (("|", ("&", "$a", "$b"), ("&", "$a", "$c")), ("&", "$a", ("|", "$b", "$c"))),
+    (("&", "$a", ("|", "$b", "$c")), ("|", ("&", "$a", "$b"), ("&", "$a", "$c"))),
+    (("&", ("|", "$a", "$b"), ("|", "$a", "$c")), ("|", "$a", ("&", "$b", "$c"))),
+
+    (("?", "$s", "$a", "$a"), "$a"),
+    (("?", "$s", "$a", "$b"), ("?", ("!", "$s"), "$b", "$a")),
+    (("?", "$s", ("&", "$a", "$b"), ("&", "$a", "$c")), ("&", "$a", ("?", "$s", "$b", "$c"))),
+    (("&", "$a", ("?", "$s", "$b", "$c")), ("?", "$s", ("&", "$a", "$b"), ("&", "$a", "$c"))),
+    (("|", ("&", "$s", "$a"), ("&", ("!", "$s"), "$b")), ("?", "$s", "$a", "$b")),
+    (("^", "$s", "$a"), ("?", "$s", ("!", "$a"), "$a")),
+]
+
+
+def _binary(term):
+    if type(term) is not tuple:
+        return term
+    args = tuple(map(_binary, term[1:]))
+    if term[0] in ASSOCIATIVE and len(args) > 2:
+        node = args[-1]
+        for x in reversed(args[:-1]):
+            node = (term[0], x, node)
+        return node
+    return (term[0],) + args
+
+
+def _flatten(term):
+    if type(term) is not tuple:
+        return term
+    args = []
+    for x in map(_flatten, term[1:]):
+        if term[0] in ASSOCIATIVE and match_op(x, term[0]):
+            args.extend(x[1:])
+        else:
+            args.append(x)
+    return (term[0],) + tuple(args)
+
+
+class EGraph:
+    def __init__(self):
+        self.parent = []
+        self.nodes = []
+        self.hashcons = {}
+
+    def find(self, cid):
+        root = cid
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[cid] != root:
+            self.parent[cid], cid = root, self.parent[cid]
+        return root
+
+    def canonical(self, node):
+        return (node[0],) + tuple(self.find(x) for x in node[1:])
+
+    def size(self):
+        return len(self.hashcons)
+
+    def add(self, node):
+        node = self.canonical(node)
+        if node in self.hashcons:
+            return self.find(self.hashcons[node])
+
+        cid = len(self.parent)
+        self.parent.append(cid)
+        self.nodes.append(set([node]))
+        self.hashcons[node] = cid
+        return cid
+
+    def add_term(self, term):
+        if type(term) is not tuple:
+            return self.add((term,))
+        return self.add((term[0],) + tuple(self.add_term(x) for x in term[1:]))
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return False
+        if len(self.nodes[a]) < len(self.nodes[b]):
+            a, b = b, a
+        self.parent[b] = a
+        self.nodes[a] |= self.nodes[b]
+        self.nodes[b] = set()
+        return True
+
+    def classes(self):
+        return [cid for cid in range(len(self.parent)) if self.parent[cid] == cid]
+
+    def rebuild(self):
+        # Restore congruence: equal canonical nodes must share a class
+        changed = True
+        while changed:
+            changed = False
+            self.hashcons = {}
+            for cid in self.classes():
+                if self.parent[cid] != cid:
+                    continue
+                for node in [self.canonical(x) for x in self.nodes[cid]]:
+                    other = self.hashcons.get(node)
+                    if other is not None and self.find(other) != self.find(cid):
+                        self.union(other, cid)
+                        changed = True
+                    self.hashcons[node] = self.find(cid)
+
+        for cid in self.classes():
+            self.nodes[cid] = set(self.canonical(x) for x in self.nodes[cid])
+
+    def ematch(self, pattern, cid, bindings):
+        cid = self.find(cid)
+        if is_var(pattern):
+            if pattern in bindings:
+                if self.find(bindings[pattern]) == cid:
+                    yield bindings
+                return
+            bindings = dict(bindings)
+            bindings[pattern] = cid
+            yield bindings
+            return
+
+        if type(pattern) is not tuple:
+            if (pattern,) in self.nodes[cid]:
+                yield bindings
+            return
+
+        for node in list(self.nodes[cid]):
+            if node[0] != pattern[0] or len(node) != len(pattern):
+                continue
+            yield from self._ematch_args(pattern[1:], node[1:], bindings)
+
+    def _ematch_args(self, patterns, args, bindings):
+        if not patterns:
+            yield bindings
+            return
+        for b in self.ematch(patterns[0], args[0], bindings):
+            yield from self._ematch_args(patterns[1:], args[1:], b)
+
+    def instantiate(self, template, bindings):
+        if is_var(template):
+            return bindings[template]
+        if type(template) is not tuple:
+            return self.add((template,))
+        return self.add((template[0],) + tuple(self.instantiate(x, bindings) for x in template[1:]))
+
+    def saturate(self, rules, node_limit, deadline, iter_limit=10):
+        # deadline is a time.perf_counter() value, shared by every term of a run
+        for _ in range(iter_limit):
+            matches = []
+            for lhs, rhs in rules:
+                for cid in self.classes():
+                    if time.perf_counter() > deadline:
+                        break
+                    for bindings in self.ematch(lhs, cid, {}):
+                        matches.append((cid, rhs, bindings))
+                if time.perf_counter() > deadline:
+                    break
+
+            changed = False
+            for cid, rhs, bindings in matches:
+                changed |= self.union(cid, self.instantiate(rhs, bindings))
+                if self.size() > node_limit or time.perf_counter() > deadline:
+                    break
+            self.rebuild()
+
+            if not changed or self.size() > node_limit or time.perf_counter() > deadline:
+                break
+
+    def _cost(self, cid, node, best):
+        # (closed LUTs, inputs of the LUT still open, is a LUT output)
+        if len(node) == 1:
+            if node[0] in ["0", "1"]:
+                return (0, frozenset(), False)
+            return (0, frozenset([node[0]]), False)
+
+        args = []
+        for x in node[1:]:
+            x = self.find(x)
+            if x not in best:
+                return None
+            args.append((x, best[x][0]))
+
+        def close(cid, cost):
+            return (cost[0] + (1 if cost[2] else 0), frozenset([cid]) if cost[1] else frozenset(), False)
+
+        if node[0] not in LUT_OPS:
+            closed = sum(close(x, c)[0] for x, c in args)
+            return (closed, frozenset([cid]), False)
+
+        # Pack children into this LUT while the inputs fit, close the widest first
+        args.sort(key=lambda x: -len(x[1][1]))
+        while True:
+            inputs = frozenset().union(*[c[1] for _, c in args])
+            if len(inputs) <= LUT_INPUTS:
+                break
+            for i, (x, c) in enumerate(args):
+                if c[2]:
+                    args[i] = (x, close(x, c))
+                    break
+            else:
+                break
+
+        return (sum(c[0] for _, c in args), inputs, True)
+
+    def extract(self):
+        def key(cost):
+            return (cost[0] + (1 if cost[2] else 0), len(cost[1]))
+
+        best = {}
+        changed = True
+        while changed:
+            changed = False
+            for cid in self.classes():
+                for node in self.nodes[cid]:
+                    cost = self._cost(cid, node, best)
+                    if cost is None:
+                        continue
+                    if cid not in best or key(cost) < key(best[cid][0]):
+                        best[cid] = (cost, node)
+                        changed = True
+
+        return {cid: (key(cost)[0], node) for cid, (cost, node) in best.items()}
+
+    def term(self, cid, best, visiting=None):
+        visiting = visiting or set()
+        cid = self.find(cid)
+        if cid in visiting:
+            raise RecursionError("cyclic extraction")
+        node = best[cid][1]
+        if len(node) == 1:
+            return node[0]
+        return (node[0],) + tuple(self.term(x, best, visiting | set([cid])) for x in node[1:])
+
+
+def default_rules():
+    rules = [(r.pattern, r.replacement) for r in RULES if r.is_template and len(r.pattern) > 1]
+    return rules + EGRAPH_RULES
+
+
+def lut_cost(term):
+    graph = EGraph()
+    root = graph.add_term(_binary(term))
+    return graph.extract()[root][0]
+
+
+def _optimize(term, rules, node_limit, deadline, iter_limit):
+    # -> (term, LUT4 before, LUT4 after, e-graph nodes used)
+    graph = EGraph()
+    root = graph.add_term(_binary(term))
+    before = graph.extract()[root][0]
+
+    graph.saturate(rules, node_limit, deadline, iter_limit)
+    best = graph.extract()
+    try:
+        result = graph.term(root, best)
+    except RecursionError:
+        return term, before, before, graph.size()
+
+    # Flattening regroups associative ops, keep it only if it packs as well
+    after = best[graph.find(root)][0]
+    if lut_cost(_flatten(result)) <= after:
+        result = _flatten(result)
+    return result, before, after, graph.size()
+
+
+def optimize_term(term, rules=None, node_limit=10000, time_limit=1.0, iter_limit=10):
+    deadline = time.perf_counter() + time_limit
+    return _optimize(term, rules or default_rules(), node_limit, deadline, iter_limit)[:3]
+
+
+def _inline(mod, expr, fanout, depth):
+    if depth <= 0:
+        return expr
+    if type(expr) is not tuple:
+        if expr in mod.combinatorial and len(fanout.get(expr, ())) == 1 and expr not in mod.outputs:
+            return _inline(mod, mod.combinatorial[expr], fanout, depth - 1)
+        return expr
+    if match_op(expr, "[]"):
+        return expr
+    return (expr[0],) + tuple(_inline(mod, x, fanout, depth) for x in expr[1:])
+
+
+def optimize_module(mod, nets=None, depth=0, node_limit=10000, time_limit=1.0, iter_limit=10, deadline=None):
+    # node_limit and time_limit are for the whole run, not for each net
+    rules = default_rules()
+    deadline = deadline or time.perf_counter() + time_limit
+    nodes = node_limit
+    fanout = mod.fanout_index() if depth > 0 else {}
+
+    targets = []
+    for net in nets if nets is not None else list(mod.combinatorial) + [x.dest for x in mod.clocked]:
+        if net in mod.combinatorial:
+            targets.append((net, None))
+        elif mod.find_ff(net):
+            targets.append((net, "ce"))
+            targets.append((net, "value"))
+
+    stats = {}
+    for net, attr in targets:
+        if attr is None:
+            expr = mod.combinatorial[net]
+        else:
+            expr = getattr(mod.find_ff(net), attr)
+        if type(expr) is not tuple:
+            continue
+
+        if nodes <= 0 or time.perf_counter() > deadline:
+            break
+
+        expr = _inline(mod, expr, fanout, depth)
+        result, before, after, used = _optimize(expr, rules, nodes, deadline, iter_limit)
+        nodes -= used
+        if after >= before:
+            continue
+
+        if attr is None:
+            mod.combinatorial[net] = result
+        else:
+            setattr(mod.find_ff(net), attr, result)
+        stats[net if attr is None else "%s.%s" % (net, attr)] = (before, after)
+
+    return stats
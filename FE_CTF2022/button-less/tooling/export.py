@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import re
+
+from expr import ParseExpr
+from module import Module
+
+
+GATE_PORTS = {
+    "$_NOT_": ["A"],
+    "$_AND_": ["A", "B"],
+    "$_OR_": ["A", "B"],
+    "$_XOR_": ["A", "B"],
+    "$_MUX_": ["A", "B", "S"],
+}
+
+BLIF_COVERS = {
+    "$_NOT_": ["0 1"],
+    "$_AND_": ["11 1"],
+    "$_OR_": ["1- 1", "-1 1"],
+    "$_XOR_": ["10 1", "01 1"],
+    "$_MUX_": ["1-0 1", "-11 1"],
+}
+
+# I1 ^ I2 ^ I3 with I0 tied low, the usual iCE40 adder LUT
+FA_LUT_INIT = 0x6996
+
+
+def _const_bits(v, width):
+    m = re.match(r"^(\d+)'d(\d+)$", v)
+    value = int(m.group(2)) if m else int(v == "1")
+    return ["1" if (value >> i) & 1 else "0" for i in range(width)]
+
+
+class Netlist:
+    def __init__(self, mod: Module):
+        self.mod = mod
+        self.cells = []
+        self.alias = {}
+        self.inverse = {}
+        self.count = 0
+
+        self.widths = dict(mod.widths)
+        for proc in mod.clocked:
+            self.widths[proc.dest] = proc.width
+
+        for net, expr in mod.combinatorial.items():
+            width = self.widths.get(net, 1)
+            if width == 1:
+                self.alias[net] = self.bit(expr)
+            else:
+                for i, bit in enumerate(self.bits(expr, width)):
+                    self.alias["%s[%d]" % (net, i)] = bit
+
+        for proc in mod.clocked:
+            self.ff(proc)
+
+    def resolve(self, sig):
+        seen = set()
+        while sig in self.alias and sig not in seen:
+            seen.add(sig)
+            sig = self.alias[sig]
+        return sig
+
+    def _new(self):
+        self.count += 1
+        return "$n%d" % self.count
+
+    def cell(self, kind, outputs, inputs, params=None):
+        self.cells.append((kind, dict(inputs), dict(outputs), params or {}))
+
+    def gate(self, kind, *args):
+        if kind == "$_NOT_":
+            if args[0] in ["0", "1"]:
+                return "1" if args[0] == "0" else "0"
+            if args[0] in self.inverse:
+                return self.inverse[args[0]]
+        if kind == "$_AND_":
+            if "0" in args:
+                return "0"
+            if args[0] == "1":
+                return args[1]
+            if args[1] == "1":
+                return args[0]
+        if kind == "$_OR_":
+            if "1" in args:
+                return "1"
+            if args[0] == "0":
+                return args[1]
+            if args[1] == "0":
+                return args[0]
+        if kind == "$_XOR_":
+            if args[0] in ["0", "1"]:
+                args = args[::-1]
+            if args[1] == "0":
+                return args[0]
+            if args[1] == "1":
+                return self.gate("$_NOT_", args[0])
+        if kind == "$_MUX_" and args[2] in ["0", "1"]:
+            return args[1] if args[2] == "1" else args[0]
+
+        out = self._new()
+        self.cell(kind, {"Y": out}, zip(GATE_PORTS[kind], args))
+        if kind == "$_NOT_":
+            self.inverse[out] = args[0]
+        return out
+
+    def carry(self, a, b, c):
+        out = self._new()
+        self.cell("SB_CARRY", {"CO": out}, {"I0": a, "I1": b, "CI": c})
+        return out
+
+    def fa(self, a, b, c):
+        out = self._new()
+        self.cell("SB_LUT4", {"O": out}, {"I0": "0", "I1": a, "I2": b, "I3": c}, {"LUT_INIT": (FA_LUT_INIT, 16)})
+        return out
+
+    def reduce(self, kind, sigs):
+        result = sigs[0]
+        for sig in sigs[1:]:
+            result = self.gate(kind, result, sig)
+        return result
+
+    def bit(self, expr):
+        if type(expr) is not tuple:
+            if expr in ["0", "1"]:
+                return expr
+            if self.widths.get(expr, 1) > 1:
+                return "%s[0]" % expr
+            return expr
+
+        op = expr[0]
+        if op == "[]":
+            return "%s[%s]" % (expr[1], expr[2])
+        if op == "!":
+            return self.gate("$_NOT_", self.bit(expr[1]))
+        if op in ["&", "|", "^"]:
+            kind = {"&": "$_AND_", "|": "$_OR_", "^": "$_XOR_"}[op]
+            return self.reduce(kind, [self.bit(x) for x in expr[1:]])
+        if op == "?":
+            return self.gate("$_MUX_", self.bit(expr[3]), self.bit(expr[2]), self.bit(expr[1]))
+        if op == "carry":
+            return self.carry(*[self.bit(x) for x in expr[1:]])
+        if op == "fa":
+            return self.fa(*[self.bit(x) for x in expr[1:]])
+        if op == "==":
+            width = max(self.width(x) for x in expr[1:])
+            a, b = [self.bits(x, width) for x in expr[1:]]
+            return self.reduce("$_AND_", [self.gate("$_NOT_", self.gate("$_XOR_", x, y)) for x, y in zip(a, b)])
+        if op == "<":
+            # a < b when a + ~b + 1 does not carry out
+            width = max(self.width(x) for x in expr[1:])
+            a, b = [self.bits(x, width) for x in expr[1:]]
+            c = "1"
+            for x, y in zip(a, b):
+                c = self.carry(x, self.gate("$_NOT_", y), c)
+            return self.gate("$_NOT_", c)
+        return self.bits(expr, 1)[0]
+
+    def width(self, expr):
+        if type(expr) is not tuple:
+            m = re.match(r"^(\d+)'d\d+$", expr)
+            if m:
+                return int(m.group(1))
+            return self.widths.get(expr, 1)
+        if expr[0] == "cat":
+            return sum(self.width(x) for x in expr[1:])
+        if expr[0] == "+":
+            return max(self.width(x) for x in expr[1:])
+        return 1
+
+    def bits(self, expr, width):
+        # LSB first, zero extended or truncated to width
+        if type(expr) is not tuple:
+            if re.match(r"^\d", expr):
+                return _const_bits(expr, width)
+            if self.widths.get(expr, 1) > 1:
+                result = ["%s[%d]" % (expr, i) for i in range(self.widths[expr])]
+            else:
+                result = [expr]
+        elif expr[0] == "cat":
+            result = []
+            for x in reversed(expr[1:]):
+                result += self.bits(x, self.width(x))
+        elif expr[0] == "+":
+            result = self.bits(expr[1], width)
+            operands = list(expr[2:])
+            while operands:
+                b = self.bits(operands.pop(0), width)
+                cin = "0"
+                if operands and self.width(operands[0]) == 1:
+                    cin = self.bit(operands.pop(0))
+                result = self.add(result, b, cin)
+        else:
+            result = [self.bit(expr)]
+
+        return (result + ["0"] * width)[:width]
+
+    def add(self, a, b, cin):
+        out = []
+        c = cin
+        for i, (x, y) in enumerate(zip(a, b)):
+            out.append(self.fa(x, y, c))
+            if i < len(a) - 1:
+                c = self.carry(x, y, c)
+        return out
+
+    def ff(self, proc):
+        reset = ParseExpr(proc.reset) if proc.reset != "0" else "0"
+        ce_reset = ParseExpr(proc.ce_reset) if proc.ce_reset != "0" else "0"
+
+        ce = self.bit(proc.ce)
+        rst = self.bit(reset)
+        # Reset is unconditional but the iCE40 reset is gated by the enable
+        enable = self.gate("$_OR_", ce, rst)
+        rst = self.gate("$_OR_", rst, self.gate("$_AND_", ce, self.bit(ce_reset)))
+
+        width = proc.width
+        values = self.bits(proc.value, width)
+        inits = _const_bits(proc.init, width) if proc.init != "x" else ["0"] * width
+        resets = _const_bits(proc.reset_value, width) if proc.reset_value != "x" else ["0"] * width
+
+        for i in range(width):
+            q = proc.dest if width == 1 else "%s[%d]" % (proc.dest, i)
+            d = values[i]
+            rv = resets[i]
+
+            # FFs power up as 0, so an FF initialised to 1 stores the inverse
+            if inits[i] == "1":
+                stored = self._new()
+                self.alias[q] = self.gate("$_NOT_", stored)
+                q = stored
+                d = self.gate("$_NOT_", d)
+                rv = "0" if rv == "1" else "1"
+
+            kind = "SB_DFF"
+            inputs = {"C": proc.clock, "D": d}
+            if enable != "1":
+                kind += "E"
+                inputs["E"] = enable
+            if rst != "0":
+                kind += "SS" if rv == "1" else "SR"
+                inputs["S" if rv == "1" else "R"] = rst
+            self.cell(kind, {"Q": q}, inputs)
+
+    def _eval(self, sig, gates, env):
+        if sig in env:
+            return env[sig]
+        if sig in ["0", "1"]:
+            return int(sig)
+        kind, inputs, _, _ = gates[sig]
+        a = [self._eval(inputs[p], gates, env) for p in GATE_PORTS[kind]]
+        if kind == "$_NOT_":
+            return 1 - a[0]
+        if kind == "$_AND_":
+            return a[0] & a[1]
+        if kind == "$_OR_":
+            return a[0] | a[1]
+        if kind == "$_XOR_":
+            return a[0] ^ a[1]
+        return a[1] if a[2] else a[0]
+
+    def pack_luts(self):
+        # Replace the generic gates by SB_LUT4 cells, merging single fanout
+        # gates into the LUT reading them while the inputs fit
+        for kind, inputs, outputs, params in self.cells:
+            for p in inputs:
+                inputs[p] = self.resolve(inputs[p])
+
+        gates = {c[2]["Y"]: c for c in self.cells if c[0] in GATE_PORTS}
+        fanout = {}
+        for kind, inputs, outputs, params in self.cells:
+            for sig in inputs.values():
+                fanout[sig] = fanout.get(sig, 0) + (1 if kind in GATE_PORTS else 2)
+        for net in self.ports()[1]:
+            sig = self.resolve(net)
+            fanout[sig] = fanout.get(sig, 0) + 2
+
+        def mergeable(sig):
+            return sig in gates and fanout.get(sig) == 1
+
+        luts = []
+        work = [sig for sig in gates if not mergeable(sig)]
+        while work:
+            root = work.pop()
+            leaves = [x for x in gates[root][1].values() if x not in ["0", "1"]]
+            leaves = sorted(set(leaves), key=leaves.index)
+            changed = True
+            while changed:
+                changed = False
+                for sig in leaves:
+                    if not mergeable(sig):
+                        continue
+                    merged = [x for x in leaves if x != sig] + [x for x in gates[sig][1].values() if x not in ["0", "1"]]
+                    merged = sorted(set(merged), key=merged.index)
+                    if len(merged) <= 4:
+                        leaves = merged
+                        changed = True
+                        break
+            work += [sig for sig in leaves if mergeable(sig)]
+
+            init = 0
+            for i in range(16):
+                env = {sig: (i >> j) & 1 for j, sig in enumerate(leaves)}
+                init |= self._eval(root, gates, env) << i
+            ports = dict(("I%d" % j, sig) for j, sig in enumerate(leaves + ["0"] * (4 - len(leaves))))
+            luts.append(("SB_LUT4", ports, {"O": root}, {"LUT_INIT": (init, 16)}))
+
+        self.cells = [c for c in self.cells if c[0] not in GATE_PORTS] + luts
+
+    def ports(self):
+        inputs = list(self.mod.inputs)
+        outputs = []
+        for net in self.mod.outputs:
+            width = self.widths.get(net, 1)
+            outputs += [net] if width == 1 else ["%s[%d]" % (net, i) for i in range(width)]
+        return inputs, outputs
+
+
+def to_blif(mod: Module, name="top"):
+    nl = Netlist(mod)
+    inputs, outputs = nl.ports()
+
+    def sig(x):
+        x = nl.resolve(x)
+        return {"0": "$false", "1": "$true"}.get(x, x)
+
+    f = []
+    f.append(".model %s" % name)
+    f.append(".inputs %s" % " ".join(inputs))
+    f.append(".outputs %s" % " ".join(outputs))
+    f.append(".names $false")
+    f.append(".names $true")
+    f.append("1")
+
+    for kind, inputs_, outputs_, params in nl.cells:
+        if kind in BLIF_COVERS:
+            f.append(".names %s %s" % (" ".join(sig(inputs_[p]) for p in GATE_PORTS[kind]), outputs_["Y"]))
+            f += BLIF_COVERS[kind]
+        else:
+            conns = ["%s=%s" % (p, sig(s)) for p, s in inputs_.items()] + ["%s=%s" % (p, s) for p, s in outputs_.items()]
+            f.append(".subckt %s %s" % (kind, " ".join(conns)))
+            for param, (value, width) in params.items():
+                f.append(".param %s %s" % (param, format(value, "0%db" % width)))
+
+    for net in outputs:
+        src = sig(net)
+        if src != net:
+            f.append(".names %s %s" % (src, net))
+            f.append("1 1")
+
+    f.append(".end")
+    return "\n".join(f) + "\n"
+
+
+def to_yosys_json(mod: Module, name="top"):
+    # Only iCE40 cells, ready for nextpnr-ice40
+    nl = Netlist(mod)
+    nl.pack_luts()
+    inputs, outputs = nl.ports()
+    ids = {}
+
+    def bit(x):
+        x = nl.resolve(x)
+        if x in ["0", "1"]:
+            return x
+        if x not in ids:
+            ids[x] = len(ids) + 2
+        return ids[x]
+
+    ports = {}
+    for net in inputs:
+        ports[net] = {"direction": "input", "bits": [bit(net)]}
+    for net in outputs:
+        ports[net] = {"direction": "output", "bits": [bit(net)]}
+
+    cells = {}
+    for i, (kind, inputs_, outputs_, params) in enumerate(nl.cells):
+        directions = {p: "input" for p in inputs_}
+        directions.update({p: "output" for p in outputs_})
+        connections = {p: [bit(s)] for p, s in list(inputs_.items()) + list(outputs_.items())}
+        cells["$cell%d" % i] = {
+            "hide_name": 1,
+            "type": kind,
+            "parameters": {p: format(v, "0%db" % w) for p, (v, w) in params.items()},
+            "attributes": {},
+            "port_directions": directions,
+            "connections": connections,
+        }
+
+    netnames = {}
+    # Gates merged into a LUT leave no net behind
+    live = set(inputs) | set(outputs) | set(s for c in nl.cells for s in c[2].values())
+    names = set(inputs) | set(outputs) | set(nl.alias) | set(ids)
+    for net in sorted(names):
+        if nl.resolve(net) not in live | {"0", "1"}:
+            continue
+        b = bit(net)
+        netnames[net] = {"hide_name": 1 if net.startswith("$") else 0, "bits": [b], "attributes": {}}
+
+    return json.dumps({
+        "creator": "cleanup3 export",
+        "modules": {
+            name: {
+                "attributes": {"top": "00000000000000000000000000000001"},
+                "ports": ports,
+                "cells": cells,
+                "netnames": netnames,
+            }
+        }
+    }, indent=2)
+
+
+def main():
+    from cleanup3 import Cleaner
+
+    parser = argparse.ArgumentParser(description="Export the cleaned design as BLIF or as yosys JSON of SB_LUT4, SB_CARRY and SB_DFF* cells for nextpnr-ice40")
+    parser.add_argument("source", nargs="?", default="test.v")
+    parser.add_argument("--names", help="icebox_vlog output to take net names from when loading an .asc")
+    parser.add_argument("-o", "--output", default="top_clean_pass3.json", help=".json or .blif")
+    parser.add_argument("--force", action="append", default=[], help="net=value, e.g. n1297=1")
+    args = parser.parse_args()
+
+    cleaner = Cleaner.load(args.source, args.names)
+    cleaner.pass1()
+    cleaner.pass2()
+    cleaner.pass3()
+    for force in args.force:
+        net, value = force.split("=")
+        cleaner.mod.replace_net(net, value)
+    cleaner.clean()
+
+    with open(args.output, "w") as f:
+        if args.output.endswith(".blif"):
+            f.write(to_blif(cleaner.mod))
+        else:
+            f.write(to_yosys_json(cleaner.mod))
+
+
+if __name__ == "__main__":
+    main()
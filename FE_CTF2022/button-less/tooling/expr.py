@@ -3,6 +3,8 @@ from pyparsing import Forward, Group, Optional, ParseResults, Word, alphanums, a
 import re
 import typing
 
+from rewrite import RewriteEngine, Rule
+
 def Parse2(node: typing.Union[str, ParseResults], n: str="top"):
     if n == "top":
         return Parse2(node[0], "expr")
@@ -48,7 +50,7 @@ def Parse2(node: typing.Union[str, ParseResults], n: str="top"):
 
 
 def escape(v: str):
-    if re.search(r"[!|&\^]", v):
+    if re.search(r"[!|&\^+=<]", v):
         return "(" + v + ")"
     return v
 
@@ -81,7 +83,8 @@ def without(n, to_remove):
     return tuple(filter(lambda x: x != to_remove, n))
 
 
-def break_shared_and(orig, n1, n2):
+def break_shared_and(l):
+    n1, n2 = l[2], l[3]
     if match_op(n1, "&") and match_op(n2, "&"):
         t1 = set(filter(lambda x: type(x) is str, n1[1:]))
         t2 = set(filter(lambda x: type(x) is str, n2[1:]))
@@ -90,114 +93,131 @@ def break_shared_and(orig, n1, n2):
 
         if t:
             n = t.pop()
-            return optimize(("&", n, ("?", orig[1], without(n1, n), without(n2, n))))
+            return ("&", n, ("?", l[1], without(n1, n), without(n2, n)))
 
-    return orig
+    return None
 
 
-def optimize(l):
-    if len(l) == 1:
-        if l[0] == "&":
-            return "1"
-        if l[0] == "|":
-            return "0"
-        if l[0] == "^":
-            raise Exception("Don't")
+def mux_const_and(l):
+    if is_const(l[2]) and match_op(l[3], "&") and in_op(l[3], l[2]):
+        return ("&", l[2], ("?", l[1], "1", without(l[3], l[2]))) # x?y:(y&z) -> y&(x?1:z)
+    if is_const(l[3]) and match_op(l[2], "&") and in_op(l[2], l[3]):
+        return ("&", l[3], ("?", l[1], without(l[2], l[3]), "1")) # x?(y&z):y -> y&(x?z:1)
+    return None
 
-    if type(l) is tuple:
-        l = (l[0],) + tuple(map(optimize, l[1:]))
-
-    if l[0] == "?":
-        if l[3] == "0":
-            return optimize(("&", l[1], l[2])) # x?y:0 -> x&y
-        if l[2] == "0":
-            return optimize(("&", ("!", l[1]), l[3])) # x?0:y -> !x&y
-
-        if l[3] == "1":
-            return optimize(("|", ("!", l[1]), l[2])) # x?y:1 -> !x|y
-        if l[2] == "1":
-            return optimize(("|", l[1], l[3])) # x?1:y -> x|y
-
-        if match_op(l[3], "!") and (l[2] == l[3][1]):
-            return optimize(("!", ("^", l[1], l[2]))) # x?y:!y -> !x^y
-        if match_op(l[2], "!") and (l[3] == l[2][1]):
-            return optimize(("^", l[1], l[3])) # x?!y:y -> x^y
-
-        if match_op(l[2], "!") and match_op(l[3], "!"):
-            return optimize(("!", ("?", l[1], l[2][1], l[3][1]))) # x?!y:!z -> !(x?y:z)
-
-        if is_const(l[2]) and match_op(l[3], "&") and in_op(l[3], l[2]):
-            return optimize(("&", l[2], ("?", l[1], "1", without(l[3], l[2])))) # x?y:(y&z) -> y&(x?1:z)
-        if is_const(l[3]) and match_op(l[2], "&") and in_op(l[2], l[3]):
-            return optimize(("&", l[3], ("?", l[1], without(l[2], l[3]), "1"))) # x?(y&z):y -> y&(x?z:1)
-
-        return break_shared_and(l, l[2], l[3]) # Generalization of above
-        
-    if l[0] == "!":
-        if match_op(l[1], "!"):
-            return optimize(l[1][1])
-        if l[1] == "1":
-            return "0"
-        if l[1] == "0":
-            return "1"
-        if match_op(l[1], "|"):
-            # De Morgan, prefer and
-            return ("&",) + tuple(map(lambda x: ("!", x), l[1][1:]))
-
-    if l[0] == "carry":
-        if l[1] in ["0", "1"]:
-            return ("carry", l[2], l[1], l[3])
-
-
-    if l[0] == "^":
-        if len(l) == 2:
-            return l[1]
-        got = False
-        flip = False
-        new = list(l)
-        for i, n in enumerate(l[1:]):
-            if match_op(n, "!"):
-                got = True
-                flip = not flip
-                new[i+1] = n[1]
-        if flip:
-            return optimize(("!", tuple(new)))
-        elif got:
-            return optimize(tuple(new))
-        
-        cnt = count_const(l, "1")
-        if cnt > 0:
-            if (cnt % 2) != 0:
-                return optimize(("!", without(l, "1")))
-            else:
-                return optimize(without(l, "1"))
-
-        if match_op(l[-1], "^"):
-            return optimize(("^",) + tuple(l[-1][1:]) + l[1:-1])
-        
-    if l[0] == "&":
-        if has_const(l, "0"):
-            return "0"
-        if has_const(l, "1"):
-            return optimize(without(l, "1"))
 
-        if len(l) == 2:
-            return l[1]
-        if match_op(l[-1], "&"):
-            return optimize(("&",) + tuple(l[-1][1:]) + l[1:-1])
-        
-        if all(map(lambda x: x[0] == "!", l[1:])):
-            return optimize(("!", ("|",) + tuple(map(lambda x: x[1], l[1:]))))
-
-    if l[0] == "|":
-        if len(l) == 2:
-            return l[1]
-        if match_op(l[-1], "|"):
-            return optimize(("|",) + tuple(l[-1][1:]) + l[1:-1])
-        if all(map(lambda x: x[0] == "!", l[1:])):
-            return optimize(("!", ("&",) + tuple(map(lambda x: x[1], l[1:]))))
+def de_morgan(l):
+    if match_op(l[1], "|"):
+        # De Morgan, prefer and
+        return ("&",) + tuple(map(lambda x: ("!", x), l[1][1:]))
+    return None
+
+
+def carry_const_last(l):
+    if l[1] in ["0", "1"]:
+        return ("carry", l[2], l[1], l[3])
+    return None
+
+
+def xor_pull_not(l):
+    got = False
+    flip = False
+    new = list(l)
+    for i, n in enumerate(l[1:]):
+        if match_op(n, "!"):
+            got = True
+            flip = not flip
+            new[i+1] = n[1]
+    if flip:
+        return ("!", tuple(new))
+    elif got:
+        return tuple(new)
+    return None
+
+
+def xor_drop_ones(l):
+    cnt = count_const(l, "1")
+    if cnt > 0:
+        if (cnt % 2) != 0:
+            return ("!", without(l, "1"))
+        else:
+            return without(l, "1")
+    return None
+
+
+def single(l):
+    if len(l) == 2:
+        return l[1]
+    return None
+
+
+def flatten_last(l):
+    if match_op(l[-1], l[0]):
+        return (l[0],) + tuple(l[-1][1:]) + l[1:-1]
+    return None
+
 
-    return l
+def and_consts(l):
+    if has_const(l, "0"):
+        return "0"
+    if has_const(l, "1"):
+        return without(l, "1")
+    return None
+
+
+def all_inverted(l):
+    if all(map(lambda x: x[0] == "!", l[1:])):
+        dual = "|" if l[0] == "&" else "&"
+        return ("!", (dual,) + tuple(map(lambda x: x[1], l[1:])))
+    return None
+
+
+def empty_xor(l):
+    raise Exception("Don't")
+
+
+RULES = [
+    Rule("&", ("&",), "1"),
+    Rule("|", ("|",), "0"),
+    Rule("^", ("^",), empty_xor),
+
+    Rule("?", ("?", "$x", "$y", "0"), ("&", "$x", "$y")), # x?y:0 -> x&y
+    Rule("?", ("?", "$x", "0", "$y"), ("&", ("!", "$x"), "$y")), # x?0:y -> !x&y
+    Rule("?", ("?", "$x", "$y", "1"), ("|", ("!", "$x"), "$y")), # x?y:1 -> !x|y
+    Rule("?", ("?", "$x", "1", "$y"), ("|", "$x", "$y")), # x?1:y -> x|y
+    Rule("?", ("?", "$x", "$y", ("!", "$y")), ("!", ("^", "$x", "$y"))), # x?y:!y -> !x^y
+    Rule("?", ("?", "$x", ("!", "$y"), "$y"), ("^", "$x", "$y")), # x?!y:y -> x^y
+    Rule("?", ("?", "$x", ("!", "$y"), ("!", "$z")), ("!", ("?", "$x", "$y", "$z"))), # x?!y:!z -> !(x?y:z)
+    Rule("?", mux_const_and),
+    Rule("?", break_shared_and), # Generalization of above
+
+    Rule("!", ("!", ("!", "$x")), "$x"),
+    Rule("!", ("!", "1"), "0"),
+    Rule("!", ("!", "0"), "1"),
+    Rule("!", de_morgan, final=True),
+
+    Rule("carry", carry_const_last, final=True),
+
+    Rule("^", single, name="^:single", final=True),
+    Rule("^", xor_pull_not),
+    Rule("^", xor_drop_ones),
+    Rule("^", flatten_last, name="^:flatten_last"),
+
+    Rule("&", and_consts),
+    Rule("&", single, name="&:single", final=True),
+    Rule("&", flatten_last, name="&:flatten_last"),
+    Rule("&", all_inverted, name="&:all_inverted"),
+
+    Rule("|", single, name="|:single", final=True),
+    Rule("|", flatten_last, name="|:flatten_last"),
+    Rule("|", all_inverted, name="|:all_inverted"),
+]
+
+OPTIMIZER = RewriteEngine(RULES)
+
+
+def optimize(l):
+    return OPTIMIZER.rewrite(l)
 
 
 def assemble(l):
@@ -210,6 +230,12 @@ def assemble(l):
             return "carry(%s)" % ", ".join(map(lambda x: escape(assemble(x)), l[1:]))
         if l[0] == "fa":
             return "fa(%s)" % ", ".join(map(lambda x: escape(assemble(x)), l[1:]))
+        if l[0] == "[]":
+            return "%s[%s]" % (l[1], l[2])
+        if l[0] == "cat":
+            return "{%s}" % ", ".join(map(lambda x: escape(assemble(x)), l[1:]))
+        if l[0] in ["+", "==", "<"]:
+            return (" %s " % l[0]).join(map(lambda x: escape(assemble(x)), l[1:]))
         if len(l) == 4:
             return "%s ? %s : %s" % (escape(assemble(l[1])), escape(assemble(l[2])), escape(assemble(l[3])))
     else:
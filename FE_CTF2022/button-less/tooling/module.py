@@ -1,3 +1,4 @@
+import copy
 import typing
 
 from expr import ParseExpr, match_op
@@ -11,6 +12,16 @@ def _is_in_expr(expr, net):
     return False
 
 
+def _expr_nets(expr):
+    if match_op(expr, "[]"):
+        yield expr[1]
+    elif type(expr) is tuple:
+        for x in expr[1:]:
+            yield from _expr_nets(x)
+    elif not expr[:1].isdigit():
+        yield expr
+
+
 def _replace_expr(expr, net, new_value):
     if type(expr) is tuple:
         n = [expr[0]]
@@ -29,7 +40,8 @@ def _replace_expr(expr, net, new_value):
 
 
 class ClockedExpr:
-    def __init__(self, clock, ce, dest, value, reset_value):
+    def __init__(self, clock, ce, dest, value, reset_value, width=1):
+        self.width = width
         self.init = reset_value
         self.ce = ce
         self.clock = clock
@@ -48,6 +60,7 @@ class Module:
         self._registers = {}
         self.combinatorial = {}
         self.bundles = {}
+        self.widths = {}
         self.clocked = []  # typing.List[ClockedExpr]
     
     def add_assignment(self, target, expr):
@@ -82,6 +95,63 @@ class Module:
 
         return replaced
 
+    def rename_net(self, prev, new):
+        self.replace_net(prev, new)
+
+        if prev in self.inputs:
+            self.inputs[self.inputs.index(prev)] = new
+        if prev in self.outputs:
+            self.outputs[self.outputs.index(prev)] = new
+
+        if prev in self.combinatorial:
+            val = self.combinatorial[prev]
+            del self.combinatorial[prev]
+            self.combinatorial[new] = val
+
+        if prev in self.widths:
+            self.widths[new] = self.widths.pop(prev)
+
+        for proc in self.clocked:
+            if proc.clock == prev:
+                proc.clock = new
+            if proc.dest == prev:
+                proc.dest = new
+                break
+
+    def copy(self):
+        mod = Module(list(self.inputs), list(self.outputs))
+        mod._registers = dict(self._registers)
+        mod.combinatorial = dict(self.combinatorial)
+        mod.bundles = dict(self.bundles)
+        mod.widths = dict(self.widths)
+        mod.clocked = [copy.copy(x) for x in self.clocked]
+        return mod
+
+    def fanout_index(self):
+        index = {}
+
+        for src, expr in self.combinatorial.items():
+            for net in _expr_nets(expr):
+                index.setdefault(net, set()).add(src)
+
+        for proc in self.clocked:
+            for net in _expr_nets(proc.ce):
+                index.setdefault(net, set()).add(proc.dest)
+            for net in _expr_nets(proc.value):
+                index.setdefault(net, set()).add(proc.dest)
+
+        return index
+
+    def fanin(self, net):
+        if net in self.combinatorial:
+            return set(_expr_nets(self.combinatorial[net]))
+
+        proc = self.find_ff(net)
+        if proc:
+            return set(_expr_nets(proc.ce)) | set(_expr_nets(proc.value))
+
+        return set()
+
     def find_ff(self, name):
         ff = list(filter(lambda x: x.dest == name, self.clocked))
         if ff:
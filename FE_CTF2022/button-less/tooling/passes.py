@@ -0,0 +1,262 @@
+import glob
+import hashlib
+import io
+import os
+import pickle
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Module attributes a pass may declare, rules keys are declared as "rules:<key>"
+MODULE_RESOURCES = ["combinatorial", "clocked", "inputs", "outputs", "widths", "bundles"]
+
+MACROS = {
+    "clean": ["wire_forward", "optimize", "unused"],
+    "pass1": ["clean", "clean"],
+    "pass2": [
+        "rename", "output", "ff_reset_propagate", "ff_promote_resets", "clean",
+        "carry_full_adder", "invert_ffs", "clean",
+        "align_shifts", "clean", "trace_shifts", "scan_strings",
+    ],
+    "pass3": [
+        "align_carrys", "clean",
+        "word_ops", "clean",
+        "bundle_wires", "clean",
+        # optimize would undo the e-graph's LUT packing, so it comes last
+        "egraph", "wire_forward", "unused",
+    ],
+}
+
+DEFAULT_PIPELINE = [
+    "pass1", {"dump": "top_clean_pass1.v"},
+    "pass2", {"dump": "top_clean_pass2.v"},
+    "pass3", {"dump": "top_clean_pass3.v"},
+]
+
+
+def _code_version():
+    # Cached results are only valid for the tooling that produced them
+    h = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py"))):
+        with open(filename, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def declare(reads=(), writes=(), idempotent=False, deterministic=True, when=None):
+    # idempotent passes are skipped while their reads are unchanged since
+    # they last ran. Results of passes that are not deterministic (time
+    # limits) are never reused. when names a rules key that must be non-empty.
+    for r in tuple(reads) + tuple(writes):
+        if not r.startswith("rules:") and r not in MODULE_RESOURCES:
+            raise Exception("Unknown resource %s" % r)
+
+    def wrap(func):
+        func.reads = tuple(reads)
+        func.writes = tuple(writes)
+        func.idempotent = idempotent
+        func.deterministic = deterministic
+        func.when = when
+        return func
+    return wrap
+
+
+def expand(pipeline):
+    steps = []
+    for step in pipeline:
+        if type(step) is str and step in MACROS:
+            steps += expand(MACROS[step])
+        else:
+            steps.append(step)
+    return steps
+
+
+class _ThreadStdout:
+    # Each analysis thread prints into its own buffer
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, s):
+        return getattr(self.local, "buffer", self.stream).write(s)
+
+    def flush(self):
+        getattr(self.local, "buffer", self.stream).flush()
+
+
+class PassManager:
+    def __init__(self, cleaner, cache_file=None, workers=4):
+        self.cleaner = cleaner
+        self.cache_file = cache_file
+        self.workers = workers
+
+        self.cache = {}
+        self.used = {}
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, "rb") as f:
+                    self.cache = pickle.load(f)
+            except Exception as e:
+                print("Ignoring pass cache %s: %s" % (cache_file, e), file=sys.stderr)
+
+        self.version = _code_version() if cache_file else None
+        self.fingerprints = {}
+        self.settled = {}
+        self.stats = {}
+
+    def _get(self, resource):
+        if resource.startswith("rules:"):
+            return self.cleaner.rules.get(resource[6:])
+        return getattr(self.cleaner.mod, resource)
+
+    def _set(self, resource, value):
+        setattr(self.cleaner.mod, resource, value)
+
+    def fingerprint(self, resource):
+        if resource.startswith("rules:") or resource not in self.fingerprints:
+            value = self._get(resource)
+            if resource == "clocked":
+                value = [sorted(vars(x).items()) for x in value]
+            self.fingerprints[resource] = hashlib.sha1(repr(value).encode()).hexdigest()
+        return self.fingerprints[resource]
+
+    def _func(self, name):
+        func = getattr(self.cleaner, "_pass_" + name, None)
+        if func is None or not hasattr(func, "reads"):
+            raise Exception("Unknown pass %s" % name)
+        return func
+
+    def _key(self, name, func):
+        return (name, self.version) + tuple(self.fingerprint(r) for r in func.reads)
+
+    def _stat(self, name, what, elapsed=0.0):
+        stat = self.stats.setdefault(name, {"run": 0, "skipped": 0, "cached": 0, "time": 0.0})
+        stat[what] += 1
+        stat["time"] += elapsed
+
+    def _execute(self, func):
+        # Runs a pass, returns its output and the resources it changed
+        before = {r: self.fingerprint(r) for r in func.writes}
+        buffer = io.StringIO()
+        stdout = sys.stdout
+        if isinstance(stdout, _ThreadStdout):
+            stdout.local.buffer = buffer
+        else:
+            sys.stdout = buffer
+
+        start = time.perf_counter()
+        try:
+            func()
+        finally:
+            if isinstance(stdout, _ThreadStdout):
+                del stdout.local.buffer
+            else:
+                sys.stdout = stdout
+        elapsed = time.perf_counter() - start
+
+        for r in func.writes:
+            self.fingerprints.pop(r, None)
+        changed = [r for r in func.writes if self.fingerprint(r) != before[r]]
+        return buffer.getvalue(), changed, elapsed
+
+    def run_pass(self, name):
+        func = self._func(name)
+        if func.when and not self.cleaner.rules.get(func.when):
+            self._stat(name, "skipped")
+            return ""
+
+        if not func.deterministic:
+            output, changed, elapsed = self._execute(func)
+            self._stat(name, "run", elapsed)
+            return output
+
+        # Passes that would not change anything replay their output
+        key = self._key(name, func)
+        if key in self.settled:
+            self._stat(name, "skipped")
+            return self.settled[key]
+
+        if key in self.cache:
+            output, state, fingerprints = self.cache[key]
+            for r, value in pickle.loads(state).items():
+                self._set(r, value)
+            self.fingerprints.update(fingerprints)
+            self.used[key] = self.cache[key]
+            self._stat(name, "cached")
+            return output
+
+        output, changed, elapsed = self._execute(func)
+        self._stat(name, "run", elapsed)
+
+        settled = [key] if not changed else []
+        if func.idempotent:
+            settled.append(self._key(name, func))
+        for k in settled:
+            self.settled[k] = output
+
+        if self.cache_file:
+            state = pickle.dumps({r: self._get(r) for r in func.writes})
+            fingerprints = {r: self.fingerprint(r) for r in func.writes}
+            for k in set([key] + settled):
+                self.used[k] = (output, state, fingerprints)
+        return output
+
+    def run_analyses(self, names):
+        # Passes that write nothing see the same state, so run them together
+        stdout = sys.stdout
+        sys.stdout = _ThreadStdout(stdout)
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                outputs = list(pool.map(self.run_pass, names))
+        finally:
+            sys.stdout = stdout
+        return outputs
+
+    def dump(self, filename):
+        if filename.endswith(".blif") or filename.endswith(".json"):
+            import export
+            text = export.to_blif(self.cleaner.mod) if filename.endswith(".blif") else export.to_yosys_json(self.cleaner.mod)
+        else:
+            text = self.cleaner.format()
+        with open(filename, "w") as f:
+            f.write(text)
+
+    def run(self, pipeline):
+        steps = expand(pipeline)
+
+        i = 0
+        while i < len(steps):
+            step = steps[i]
+            if type(step) is dict:
+                self.dump(step["dump"])
+                i += 1
+                continue
+
+            group = [step]
+            while not self._func(step).writes and i + len(group) < len(steps):
+                nxt = steps[i + len(group)]
+                if type(nxt) is dict or self._func(nxt).writes:
+                    break
+                group.append(nxt)
+
+            if len(group) > 1 and self.workers > 1:
+                outputs = self.run_analyses(group)
+            else:
+                outputs = [self.run_pass(name) for name in group]
+            for output in outputs:
+                sys.stdout.write(output)
+            i += len(group)
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with open(self.cache_file, "wb") as f:
+            pickle.dump(self.used, f)
+
+    def report(self):
+        lines = ["%-24s %6s %8s %7s %10s" % ("pass", "run", "skipped", "cached", "ms")]
+        for name, stat in sorted(self.stats.items(), key=lambda x: -x[1]["time"]):
+            lines.append("%-24s %6d %8d %7d %10.2f" % (name, stat["run"], stat["skipped"], stat["cached"], stat["time"] * 1000))
+        return "\n".join(lines)
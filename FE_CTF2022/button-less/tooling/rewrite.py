@@ -0,0 +1,137 @@
+import time
+import typing
+
+
+def is_var(p):
+    return type(p) is str and p.startswith("$")
+
+
+def match(pattern, node, bindings):
+    if is_var(pattern):
+        if pattern in bindings:
+            return bindings[pattern] == node
+        bindings[pattern] = node
+        return True
+
+    if type(pattern) is tuple:
+        if type(node) is not tuple or len(node) != len(pattern) or node[0] != pattern[0]:
+            return False
+        return all(match(p, n, bindings) for p, n in zip(pattern[1:], node[1:]))
+
+    return pattern == node
+
+
+def substitute(template, bindings):
+    if is_var(template):
+        return bindings[template]
+    if type(template) is tuple:
+        return (template[0],) + tuple(substitute(x, bindings) for x in template[1:])
+    return template
+
+
+class Rule:
+    # pattern is either a template like ("?", "$x", "$y", "0") or a function
+    # returning a dict of bindings (or None). replacement is either a template
+    # or a function of those bindings. Without a replacement the pattern
+    # function returns the rewritten node itself (or None).
+    # final rules are not rewritten again after they fire.
+    def __init__(self, head, pattern, replacement=None, name=None, final=False):
+        self.head = head
+        self.pattern = pattern
+        self.replacement = replacement
+        self.name = name or "%s:%s" % (head, pattern if type(pattern) is tuple else pattern.__name__)
+        self.final = final
+
+        self.tries = 0
+        self.fires = 0
+        self.time = 0.0
+
+    @property
+    def is_template(self):
+        return not callable(self.pattern) and self.replacement is not None and not callable(self.replacement)
+
+    def apply(self, node):
+        self.tries += 1
+        start = time.perf_counter()
+        try:
+            if self.replacement is None:
+                result = self.pattern(node)
+                if result is not None:
+                    self.fires += 1
+                return result
+
+            if callable(self.pattern):
+                bindings = self.pattern(node)
+                if bindings is None:
+                    return None
+            else:
+                bindings = {}
+                if not match(self.pattern, node, bindings):
+                    return None
+
+            if callable(self.replacement):
+                result = self.replacement(bindings)
+            else:
+                result = substitute(self.replacement, bindings)
+
+            if result is not None:
+                self.fires += 1
+            return result
+        finally:
+            self.time += time.perf_counter() - start
+
+
+class RewriteEngine:
+    def __init__(self, rules: typing.List[Rule] = (), memo_limit=100000):
+        self.rules = []
+        self.index = {}
+        # Rewriting is a pure function of the node, so results are memoized.
+        # The memo is dropped when full to bound a long running process.
+        self.memo = {}
+        self.memo_limit = memo_limit
+
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule: Rule):
+        self.rules.append(rule)
+        self.index.setdefault(rule.head, []).append(rule)
+        self.memo.clear()
+
+    def rewrite(self, node):
+        return self._rewrite(node)
+
+    def _rewrite(self, node):
+        if type(node) is not tuple:
+            return node
+        if node in self.memo:
+            return self.memo[node]
+
+        result = node
+        if len(node) > 1:
+            result = (node[0],) + tuple(self._rewrite(x) for x in node[1:])
+
+        # Bottom-up, then only the rules registered for this head. The
+        # result of a final rule is not rewritten again.
+        for rule in self.index.get(result[0], ()):
+            rewritten = rule.apply(result)
+            if rewritten is not None:
+                result = rewritten if rule.final else self._rewrite(rewritten)
+                break
+
+        if len(self.memo) >= self.memo_limit:
+            self.memo.clear()
+        self.memo[node] = result
+        return result
+
+    def reset_stats(self):
+        for rule in self.rules:
+            rule.tries = 0
+            rule.fires = 0
+            rule.time = 0.0
+
+    def report(self):
+        lines = ["%-40s %10s %10s %10s" % ("rule", "tries", "fires", "ms")]
+        for rule in sorted(self.rules, key=lambda x: -x.time):
+            lines.append("%-40s %10d %10d %10.2f" % (rule.name, rule.tries, rule.fires, rule.time * 1000))
+        return "\n".join(lines)
@@ -0,0 +1,221 @@
+import numpy as np
+
+from expr import match_op
+from module import Module
+
+
+# name, bits per frame, data bit positions, bits that must have a fixed value
+FRAMINGS = [
+    ("8bit", 8, list(range(8)), {}),
+    ("7bit", 7, list(range(7)), {}),
+    ("uart", 10, list(range(1, 9)), {0: 0, 9: 1}),
+]
+
+
+def _char_weights():
+    w = np.zeros(256)
+    for c in range(256):
+        ch = chr(c)
+        if ch.islower() and c < 128 or ch == " ":
+            w[c] = 3
+        elif ch.isupper() and c < 128 or ch.isdigit() and c < 128:
+            w[c] = 2
+        elif ch in "_{}":
+            w[c] = 1.5
+        elif 0x20 < c < 0x7f or ch in "\n\r\t":
+            w[c] = 0.5
+    return w
+
+
+CHAR_WEIGHTS = _char_weights()
+PRINTABLE = CHAR_WEIGHTS > 0
+# log2 likelihood of a character under a plain text model, -inf if not text
+with np.errstate(divide="ignore"):
+    CHAR_LOG2 = np.log2(CHAR_WEIGHTS / CHAR_WEIGHTS.sum())
+
+
+def _compatible(a, b):
+    return a.clock == b.clock and a.ce == b.ce and a.reset == b.reset and a.ce_reset == b.ce_reset
+
+
+def find_chains(mod: Module, min_length=8):
+    # Shift chains as (nets, inverted, cyclic), nets[0] is the FF that
+    # shifts out first, inverted[i] tells whether nets[i] arrives inverted
+    ffs = {proc.dest: proc for proc in mod.clocked if proc.width == 1}
+
+    link = {}
+    successors = {}
+    for proc in ffs.values():
+        src, neg = proc.value, False
+        if match_op(src, "!"):
+            src, neg = src[1], True
+        if type(src) is str and src in ffs and _compatible(proc, ffs[src]):
+            link[proc.dest] = (src, neg)
+            successors[src] = successors.get(src, 0) + 1
+
+    def walk(start):
+        nets, inverted = [start], [False]
+        seen = set([start])
+        net = start
+        while net in link:
+            src, neg = link[net]
+            if src in seen:
+                return nets, inverted, src == start
+            nets.append(src)
+            inverted.append(inverted[-1] ^ neg)
+            seen.add(src)
+            net = src
+        return nets, inverted, False
+
+    chains = []
+    visited = set()
+    ends = [net for net in link if successors.get(net, 0) != 1]
+    for net in ends:
+        chain = walk(net)
+        visited.update(chain[0])
+        chains.append(chain)
+
+    # Rings have no end, start them anywhere
+    for net in link:
+        if net not in visited:
+            chain = walk(net)
+            visited.update(chain[0])
+            if chain[2]:
+                chains.append(chain)
+
+    return [chain for chain in chains if len(chain[0]) >= min_length]
+
+
+def chain_bits(mod: Module, chain, attr="reset_value", ffs=None):
+    nets, inverted, cyclic = chain
+    ffs = ffs or {proc.dest: proc for proc in mod.clocked}
+    values = [getattr(ffs[net], attr) == "1" for net in nets]
+    bits = np.array(values, np.uint8) ^ np.array(inverted, np.uint8)
+    if cyclic:
+        bits = np.concatenate([bits, bits[:-1]])
+    return bits
+
+
+def _best_runs(codes, valid, bonus):
+    # Best run of text characters per row, as (score, start, length)
+    ok = valid & PRINTABLE[codes]
+    llr = np.where(ok, CHAR_LOG2[codes] + bonus, 0.0)
+
+    rows, cols = ok.shape
+    index = np.broadcast_to(np.arange(cols), ok.shape)
+    last_break = np.maximum.accumulate(np.where(ok, -1, index), axis=1)
+    total = np.concatenate([np.zeros((rows, 1)), np.cumsum(llr, axis=1)], axis=1)
+    start = last_break + 1
+    score = np.where(ok, total[:, 1:] - np.take_along_axis(total, start, axis=1), -np.inf)
+
+    end = np.argmax(score, axis=1)
+    best = score[np.arange(rows), end]
+    start = start[np.arange(rows), end]
+    return best, start, end - start + 1
+
+
+def scan_bits(bit_arrays, top=20, min_chars=4, framings=FRAMINGS):
+    # Decode every bit array at every offset, direction, inversion, bit
+    # order and framing at once, ranked by how much they look like text
+    if not bit_arrays:
+        return []
+
+    lengths = np.array([len(b) for b in bit_arrays])
+    width = lengths.max()
+    bits = np.zeros((len(bit_arrays), width), np.uint8)
+    for i, b in enumerate(bit_arrays):
+        bits[i, :len(b)] = b
+    reverse = np.zeros_like(bits)
+    for i, b in enumerate(bit_arrays):
+        reverse[i, :len(b)] = b[::-1]
+
+    # (chains, direction, inverted, bits)
+    variants = np.stack([bits, reverse], axis=1)
+    variants = np.stack([variants, variants ^ 1], axis=2)
+
+    results = []
+    for name, frame, data, fixed in framings:
+        chars = width // frame
+        if chars < min_chars:
+            continue
+
+        # (offset, char, bit) positions into the chain
+        offsets = np.arange(frame)[:, None, None]
+        index = offsets + np.arange(chars)[None, :, None] * frame + np.array(data)[None, None, :]
+        last = offsets[:, :, 0] + np.arange(chars)[None, :] * frame + frame - 1
+        valid = last[None, :, :] < lengths[:, None, None]
+
+        picked = variants[:, :, :, np.minimum(index, width - 1)]
+        lsb = (picked << np.arange(len(data))).sum(axis=-1)
+        msb = (picked << np.arange(len(data))[::-1]).sum(axis=-1)
+        # (chains, direction, inverted, order, offset, char)
+        codes = np.stack([lsb, msb], axis=3)
+        valid = np.broadcast_to(valid[:, None, None, None, :, :], codes.shape)
+
+        for pos, value in fixed.items():
+            framing = variants[:, :, :, np.minimum(last - frame + 1 + pos, width - 1)] == value
+            valid = valid & framing[:, :, :, None, :, :]
+
+        bonus = len(data) + len(fixed)
+        rows = codes.reshape(-1, chars)
+        score, start, length = _best_runs(rows, valid.reshape(-1, chars), bonus)
+        shape = codes.shape[:-1]
+        score[(length < min_chars) | (score <= 0)] = -np.inf
+        # Only decode the best few, leaving room for duplicates
+        best = np.argsort(-score)[:top * 8]
+        for flat in best[np.isfinite(score[best])]:
+            chain, direction, inverted, order, offset = np.unravel_index(flat, shape)
+            text = bytes(rows[flat][start[flat]:start[flat] + length[flat]].astype(np.uint8)).decode("latin-1")
+            results.append({
+                "chain": int(chain),
+                "framing": name,
+                "reversed": bool(direction),
+                "inverted": bool(inverted),
+                "msb_first": bool(order),
+                "offset": int(offset + start[flat] * frame),
+                "score": float(score[flat]),
+                "text": text,
+            })
+
+    results.sort(key=lambda x: -x["score"])
+
+    # The same text shows up at neighbouring offsets and framings
+    seen = set()
+    ranked = []
+    for r in results:
+        if (r["chain"], r["text"]) in seen:
+            continue
+        seen.add((r["chain"], r["text"]))
+        ranked.append(r)
+    return ranked[:top]
+
+
+def scan_module(mod: Module, top=20, min_chars=4, min_length=8):
+    chains = find_chains(mod, min_length)
+    ffs = {proc.dest: proc for proc in mod.clocked}
+
+    arrays, sources = [], []
+    for chain in chains:
+        for attr in ["reset_value", "init"]:
+            bits = chain_bits(mod, chain, attr, ffs)
+            if attr == "init" and arrays and sources[-1][0] is chain and np.array_equal(arrays[-1], bits):
+                continue
+            arrays.append(bits)
+            sources.append((chain, attr))
+
+    results = scan_bits(arrays, top, min_chars)
+    for r in results:
+        chain, attr = sources[r.pop("chain")]
+        r["chain"] = chain[0][0]
+        r["length"] = len(chain[0])
+        r["source"] = attr
+    return results
+
+
+def format_result(r):
+    return "%-10s %5.1f %s%s%s %-4s +%-4d '%s'" % (
+        r.get("chain", ""), r["score"],
+        "r" if r["reversed"] else "-",
+        "i" if r["inverted"] else "-",
+        "m" if r["msb_first"] else "l",
+        r["framing"], r["offset"], r["text"].encode("unicode_escape").decode())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import argparse
+import copy
+import io
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+
+from cleanup3 import Cleaner
+from expr import OPTIMIZER, assemble
+from passes import MACROS
+
+
+class AnalysisServer:
+    def __init__(self, cleaner: Cleaner):
+        self.cleaner = cleaner
+        self.journal = []
+        self._fanout = None
+
+        self.methods = {
+            "fanin": self.fanin,
+            "fanout": self.fanout,
+            "cone": self.cone,
+            "rename": self.rename,
+            "apply_pass": self.apply_pass,
+            "set_rule": self.set_rule,
+            "format": self.format,
+            "undo": self.undo,
+            "stats": self.stats,
+            "rule_stats": self.rule_stats,
+        }
+
+    @property
+    def mod(self):
+        return self.cleaner.mod
+
+    def _index(self):
+        if self._fanout is None:
+            self._fanout = self.mod.fanout_index()
+        return self._fanout
+
+    def _checkpoint(self, what):
+        self.journal.append((what, self.mod.copy(), copy.deepcopy(self.cleaner.rules)))
+        self._fanout = None
+
+    def _driver(self, net):
+        if net in self.mod.combinatorial:
+            return assemble(self.mod.combinatorial[net])
+        proc = self.mod.find_ff(net)
+        if proc:
+            return "%s ? %s : %s" % (assemble(proc.ce), assemble(proc.value), net)
+        return None
+
+    def _cone(self, nets, step, depth, stop_at_ff):
+        cone = set(nets)
+        front = set(nets)
+
+        while front and depth != 0:
+            depth -= 1
+            nxt = set()
+            for net in front:
+                if stop_at_ff and net not in nets and self.mod.find_ff(net):
+                    continue
+                nxt |= step(net)
+            front = nxt - cone
+            cone |= front
+
+        return cone
+
+    def fanin(self, net, depth=1):
+        nets = self._cone([net], self.mod.fanin, depth, False)
+        return {x: self._driver(x) for x in sorted(nets)}
+
+    def fanout(self, net, depth=1):
+        index = self._index()
+        nets = self._cone([net], lambda x: index.get(x, set()), depth, False)
+        nets.discard(net)
+        return {x: self._driver(x) for x in sorted(nets)}
+
+    def cone(self, nets, depth=-1, direction="in", stop_at_ff=True):
+        if type(nets) is str:
+            nets = [nets]
+        if direction == "in":
+            step = self.mod.fanin
+        else:
+            index = self._index()
+            step = lambda x: index.get(x, set())
+
+        return self.cleaner.format(self._cone(nets, step, depth, stop_at_ff))
+
+    def rename(self, prev, new, dry_run=False):
+        mod = self.mod
+        if prev not in mod.inputs and prev not in mod.outputs and prev not in mod.combinatorial and not mod.find_ff(prev):
+            raise KeyError("Unknown net %s" % prev)
+
+        self._checkpoint("rename %s -> %s" % (prev, new))
+        self.cleaner.rules["rename"][prev] = new
+        self.mod.rename_net(prev, new)
+
+        affected = set([new]) | self._index().get(new, set())
+        result = self.cleaner.format(affected)
+        if dry_run:
+            self.undo()
+        return result
+
+    def apply_pass(self, name):
+        if name not in MACROS and not hasattr(getattr(self.cleaner, "_pass_" + name, None), "reads"):
+            raise KeyError("Unknown pass %s" % name)
+
+        self._checkpoint("pass %s" % name)
+        out = io.StringIO()
+        with redirect_stdout(out):
+            self.cleaner.run_passes([name])
+        return out.getvalue()
+
+    def set_rule(self, key, value):
+        self._checkpoint("rule %s" % key)
+        self.cleaner.rules[key] = value
+
+    def format(self, nets=None):
+        return self.cleaner.format(nets)
+
+    def undo(self, steps=1):
+        undone = []
+        for _ in range(min(steps, len(self.journal))):
+            what, mod, rules = self.journal.pop()
+            self.cleaner.mod = mod
+            self.cleaner.rules = rules
+            undone.append(what)
+        self._fanout = None
+        return undone
+
+    def stats(self):
+        return {
+            "combinatorial": len(self.mod.combinatorial),
+            "clocked": len(self.mod.clocked),
+            "journal": [x[0] for x in self.journal],
+        }
+
+    def rule_stats(self, reset=False):
+        report = OPTIMIZER.report()
+        if reset:
+            OPTIMIZER.reset_stats()
+        return report
+
+    def handle(self, request):
+        req_id = request.get("id")
+        if request.get("method") not in self.methods:
+            return {"jsonrpc": "2.0", "id": req_id, "error": {"code": -32601, "message": "Unknown method %s" % request.get("method")}}
+
+        try:
+            params = request.get("params", {})
+            method = self.methods[request["method"]]
+            start = time.perf_counter()
+            if type(params) is list:
+                result = method(*params)
+            else:
+                result = method(**params)
+            elapsed = time.perf_counter() - start
+            return {"jsonrpc": "2.0", "id": req_id, "result": result, "time_ms": elapsed * 1000}
+        except Exception as e:
+            traceback.print_exc(file=sys.stderr)
+            return {"jsonrpc": "2.0", "id": req_id, "error": {"code": -32000, "message": "%s: %s" % (e.__class__.__name__, e)}}
+
+    def serve(self, rfile, wfile):
+        for line in rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                response = {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": str(e)}}
+            else:
+                response = self.handle(request)
+            wfile.write(json.dumps(response) + "\n")
+            wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep a design loaded and answer JSON-RPC queries, one request per line")
+    parser.add_argument("source", nargs="?", default="test.v", help="Verilog from icebox_vlog or an icestorm .asc")
+    parser.add_argument("--names", help="icebox_vlog output to take net names from when loading an .asc")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of stdio")
+    args = parser.parse_args()
+
+    # The parser reports unknown nodes on stdout, which is the JSON-RPC stream
+    with redirect_stdout(sys.stderr):
+        cleaner = Cleaner.load(args.source, args.names)
+    server = AnalysisServer(cleaner)
+
+    if not args.socket:
+        server.serve(sys.stdin, sys.stdout)
+        return
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(args.socket)
+    sock.listen(1)
+    try:
+        while True:
+            conn, _ = sock.accept()
+            with conn, conn.makefile("r") as rfile, conn.makefile("w") as wfile:
+                server.serve(rfile, wfile)
+    finally:
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
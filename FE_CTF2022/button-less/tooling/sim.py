@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import re
+import sys
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from expr import ParseExpr, match_op
+from module import Module, _expr_nets
+
+
+def _const(v):
+    m = re.match(r"^(\d+)'d(\d+)$", v)
+    if m:
+        return int(m.group(2))
+    if v in ["0", "1"]:
+        return int(v)
+    if v == "x":
+        return 0
+    return None
+
+
+def _other(expr, net):
+    return expr[2] if expr[1] == net else expr[1]
+
+
+class UartDecoder:
+    def __init__(self, cycles_per_bit, data_bits=8):
+        self.cpb = cycles_per_bit
+        self.data_bits = data_bits
+        self.data = bytearray()
+        self.errors = 0
+
+        self.value = 1
+        self.start = None
+        self.edges = []
+
+    def _end(self):
+        return self.start + (self.data_bits + 1.5) * self.cpb
+
+    def _value_at(self, t):
+        value = self.edges[0][1]
+        for cycle, v in self.edges:
+            if cycle > t:
+                break
+            value = v
+        return value
+
+    def _decode(self):
+        bits = [self._value_at(self.start + (1.5 + i) * self.cpb) for i in range(self.data_bits)]
+        if self._value_at(self.start + 0.5 * self.cpb) != 0:
+            self.errors += 1
+        else:
+            if self._value_at(self._end()) != 1:
+                self.errors += 1
+            self.data.append(sum(b << i for i, b in enumerate(bits)))
+        self.start = None
+
+    def flush(self, cycle):
+        if self.start is not None and cycle > self._end():
+            self._decode()
+
+    def feed(self, cycle, value):
+        self.flush(cycle)
+        if self.start is None:
+            if self.value == 1 and value == 0:
+                self.start = cycle
+                self.edges = [(cycle, 0)]
+        else:
+            self.edges.append((cycle, value))
+        self.value = value
+
+
+def uart_stimulus(net, data, cycles_per_bit, start=0, data_bits=8):
+    schedule = {}
+    t = start
+    for byte in data:
+        frame = [0] + [(byte >> i) & 1 for i in range(data_bits)] + [1]
+        for bit in frame:
+            schedule.setdefault(int(t), {})[net] = bit
+            t += cycles_per_bit
+    return schedule
+
+
+class Simulator:
+    def __init__(self, mod: Module, clock=None):
+        self.mod = mod
+        if clock is None and mod.clocked:
+            clocks = [x.clock for x in mod.clocked]
+            clock = max(set(clocks), key=clocks.count)
+        self.clock = clock
+        self.procs = [x for x in mod.clocked if x.clock == clock]
+
+        # Only one clock domain is simulated, other FFs keep their init value
+        frozen = [x.dest for x in mod.clocked if x.clock != clock]
+        if frozen:
+            others = sorted(set(x.clock for x in mod.clocked if x.clock != clock))
+            print("warning: simulating %s only, %d FFs on %s are held at their init value" % (
+                clock, len(frozen), ", ".join(others)), file=sys.stderr)
+
+        self.ids = {}
+        self.names = []
+        self.widths = []
+        self.values = []
+
+        def declare(net, width=1, value=0):
+            if net not in self.ids:
+                self.ids[net] = len(self.names)
+                self.names.append(net)
+                self.widths.append(width)
+                self.values.append(value)
+            return self.ids[net]
+
+        for net in mod.inputs:
+            declare(net)
+        for proc in mod.clocked:
+            declare(proc.dest, proc.width, _const(proc.init) or 0)
+        for net in mod.combinatorial:
+            declare(net, mod.widths.get(net, 1))
+
+        # Anything else referenced is undriven and stays 0
+        for net, expr in mod.combinatorial.items():
+            for x in _expr_nets(expr):
+                declare(x)
+        for proc in self.procs:
+            for x in list(_expr_nets(proc.ce)) + list(_expr_nets(proc.value)) + list(_expr_nets(self._reset(proc.reset))) + list(_expr_nets(self._reset(proc.ce_reset))):
+                declare(x)
+
+        self.comb = {}
+        for net, expr in mod.combinatorial.items():
+            self.comb[self.ids[net]] = self._compile(expr, mod.widths.get(net, 1))
+
+        self.next_state = [self._compile_ff(proc) for proc in self.procs]
+        self.ff_ids = [self.ids[proc.dest] for proc in self.procs]
+
+        self.comb_sinks = [[] for _ in self.names]
+        self.ff_sinks = [[] for _ in self.names]
+        for net, expr in mod.combinatorial.items():
+            for x in set(_expr_nets(expr)):
+                self.comb_sinks[self.ids[x]].append(self.ids[net])
+        for i, proc in enumerate(self.procs):
+            nets = set(_expr_nets(proc.ce)) | set(_expr_nets(proc.value)) | set(_expr_nets(self._reset(proc.reset))) | set(_expr_nets(self._reset(proc.ce_reset)))
+            for x in nets:
+                self.ff_sinks[self.ids[x]].append(i)
+
+        self.level = self._levelize()
+        self.watchers = {}
+        self.cycle = 0
+        self.skipped = 0
+
+        self.changed = set()
+        self.dirty = set(range(len(self.procs)))
+        for net in sorted(self.comb, key=lambda x: self.level[x]):
+            self.values[net] = self.comb[net](self.values)
+
+        self.counters = self._find_counters()
+
+    def _reset(self, expr):
+        return ParseExpr(expr) if type(expr) is str and expr not in ["0", "1"] else expr
+
+    def _code(self, e):
+        if type(e) is not tuple:
+            c = _const(e)
+            if c is not None:
+                return str(c)
+            return "v[%d]" % self.ids[e]
+
+        op = e[0]
+        if op == "[]":
+            return "((%s>>%s)&1)" % (self._code(e[1]), e[2])
+
+        args = [self._code(x) for x in e[1:]]
+        if op == "!":
+            return "(1^%s)" % args[0]
+        if op in ["&", "|", "^"]:
+            return "(%s)" % op.join(args)
+        if op == "?":
+            return "(%s if %s else %s)" % (args[1], args[0], args[2])
+        if op == "carry":
+            return "((%s&%s)|((%s|%s)&%s))" % (args[0], args[1], args[0], args[1], args[2])
+        if op == "fa":
+            return "(%s^%s^%s)" % tuple(args)
+        if op == "cat":
+            return "(%s)" % "|".join("(%s<<%d)" % (x, len(args) - 1 - i) for i, x in enumerate(args))
+        if op == "+":
+            return "(%s)" % "+".join(args)
+        if op == "==":
+            return "(1 if %s == %s else 0)" % tuple(args)
+        if op == "<":
+            return "(1 if %s < %s else 0)" % tuple(args)
+        raise NotImplementedError(op)
+
+    def _compile(self, expr, width):
+        return eval("lambda v: %s & %d" % (self._code(expr), (1 << width) - 1))
+
+    def _compile_ff(self, proc):
+        q = "v[%d]" % self.ids[proc.dest]
+        code = "(%s if %s else %s)" % (self._code(proc.value), self._code(proc.ce), q)
+        rv = str(_const(proc.reset_value) or 0)
+        if proc.reset != "0":
+            code = "(%s if %s else %s)" % (rv, self._code(self._reset(proc.reset)), code)
+        if proc.ce_reset != "0":
+            code = "(%s if (%s) & (%s) else %s)" % (rv, self._code(proc.ce), self._code(self._reset(proc.ce_reset)), code)
+        return eval("lambda v: %s & %d" % (code, (1 << proc.width) - 1))
+
+    def _levelize(self):
+        level = [0] * len(self.names)
+        pending = {net: 0 for net in self.comb}
+        for net in self.comb:
+            for sink in self.comb_sinks[net]:
+                pending[sink] += 1
+
+        ready = [net for net, cnt in pending.items() if cnt == 0]
+        done = 0
+        while ready:
+            net = ready.pop()
+            done += 1
+            for sink in self.comb_sinks[net]:
+                level[sink] = max(level[sink], level[net] + 1)
+                pending[sink] -= 1
+                if pending[sink] == 0:
+                    ready.append(sink)
+
+        if done != len(self.comb):
+            raise Exception("Combinatorial loop")
+        return level
+
+    def _find_counters(self):
+        # Free running word counters, cnt <= cnt + K (+ cin), whose readers are
+        # all taps or compares that can be evaluated for many counter values at
+        # once. The carry in only changes when a reader does, which ends a jump.
+        counters = {}
+        for i, proc in enumerate(self.procs):
+            if proc.width < 2 or proc.reset != "0" or proc.ce_reset != "0":
+                continue
+            value = proc.value
+            if not (match_op(value, "+") and len(value) in [3, 4] and value[1] == proc.dest):
+                continue
+            step = _const(value[2]) if type(value[2]) is str else None
+            cin = None
+            if len(value) == 4:
+                if type(value[3]) is not str:
+                    continue
+                if _const(value[3]) is not None:
+                    step = step + _const(value[3]) if step is not None else None
+                elif value[3] in self.ids and value[3] != proc.dest:
+                    cin = self.ids[value[3]]
+                else:
+                    continue
+            reg = self.ids[proc.dest]
+            if step is None or self.ff_sinks[reg] != [i]:
+                continue
+
+            observers = []
+            for sink in self.comb_sinks[reg]:
+                fn = self._observer(proc.dest, self.mod.combinatorial[self.names[sink]])
+                if fn is None or reg in self.watchers:
+                    observers = None
+                    break
+
+                # Bit taps only read by compares over the same counter are looked through
+                inner = None
+                if fn[1] and not self.ff_sinks[sink] and sink not in self.watchers:
+                    inner = [self._cat_observer(proc.dest, x) for x in self.comb_sinks[sink]]
+                if inner is not None and all(x is not None for x in inner):
+                    observers.extend(inner)
+                else:
+                    observers.append(fn[0])
+
+            if observers is not None:
+                counters[i] = (reg, step, cin, observers)
+        return counters
+
+    def _observer(self, reg, expr):
+        # -> (function of the counter value, is a single bit tap)
+        if match_op(expr, "[]") and expr[1] == reg:
+            bit = int(expr[2])
+            return (lambda x: (x >> bit) & 1), True
+        if match_op(expr, "==") and reg in expr[1:]:
+            k = _const(_other(expr, reg))
+            if k is not None:
+                return (lambda x: x == k), False
+        if match_op(expr, "<") and expr[1] == reg:
+            k = _const(expr[2])
+            if k is not None:
+                return (lambda x: x < k), False
+        if match_op(expr, "<") and expr[2] == reg:
+            k = _const(expr[1])
+            if k is not None:
+                return (lambda x: x > k), False
+        return None
+
+    def _cat_observer(self, reg, net):
+        expr = self.mod.combinatorial.get(self.names[net])
+        if not (match_op(expr, "==") and match_op(expr[1], "cat")):
+            return None
+        k = _const(expr[2])
+        bits = []
+        for x in expr[1][1:]:
+            tap = self.mod.combinatorial.get(x) if type(x) is str else x
+            if not (match_op(tap, "[]") and tap[1] == reg):
+                return None
+            bits.append(int(tap[2]))
+        n = len(bits)
+        return lambda x: sum(((x >> b) & 1) << (n - 1 - i) for i, b in enumerate(bits)) == k
+
+    def get(self, net):
+        return self.values[self.ids[net]]
+
+    def set(self, net, value):
+        i = self.ids[net]
+        if self.values[i] != value:
+            self._update(i, value)
+
+    def watch(self, net, callback):
+        self.watchers.setdefault(self.ids[net], []).append(callback)
+        self.counters = self._find_counters()
+
+    def uart(self, net, baud, clock_hz=12e6, data_bits=8):
+        decoder = UartDecoder(clock_hz / baud, data_bits)
+        decoder.value = self.get(net)
+        self.watch(net, decoder.feed)
+        return decoder
+
+    def _update(self, i, value):
+        self.values[i] = value
+        self.changed.add(i)
+        self.dirty.update(self.ff_sinks[i])
+        for callback in self.watchers.get(i, ()):
+            callback(self.cycle, value)
+
+    def propagate(self):
+        heap = []
+        queued = set()
+        for net in self.changed:
+            for sink in self.comb_sinks[net]:
+                if sink not in queued:
+                    queued.add(sink)
+                    heapq.heappush(heap, (self.level[sink], sink))
+        self.changed = set()
+
+        while heap:
+            _, net = heapq.heappop(heap)
+            value = self.comb[net](self.values)
+            if value != self.values[net]:
+                self._update(net, value)
+                for sink in self.comb_sinks[net]:
+                    if sink not in queued:
+                        queued.add(sink)
+                        heapq.heappush(heap, (self.level[sink], sink))
+        self.changed = set()
+
+    def _skip(self, limit):
+        # Everything still moving is a free running counter: jump ahead to
+        # just before the first cycle where anything reading them changes
+        if limit < 2 or not self.dirty or not self.dirty.issubset(self.counters):
+            return
+
+        states = []
+        for i in self.dirty:
+            reg, step, cin, observers = self.counters[i]
+            if cin is not None:
+                step += self.values[cin]
+            if self.next_state[i](self.values) != (self.values[reg] + step) & ((1 << self.procs[i].width) - 1):
+                return
+            states.append((i, reg, step))
+
+        jump = limit - 1
+        block = 256
+        offset = 1
+        while offset <= jump:
+            n = min(block, jump - offset + 1)
+            steps = np.arange(offset, offset + n, dtype=np.int64)
+            first = n
+            for i, reg, step in states:
+                width = self.procs[i].width
+                now = self.values[reg]
+                seq = (now + steps * step) & ((1 << width) - 1)
+                for fn in self.counters[i][3]:
+                    moved = np.nonzero(np.asarray(fn(seq)) != fn(now))[0]
+                    if len(moved):
+                        first = min(first, moved[0])
+            if first < n:
+                jump = int(offset + first) - 1
+                break
+            offset += n
+            block *= 4
+
+        if jump < 1:
+            return
+
+        for i, reg, step in states:
+            self.values[reg] = (self.values[reg] + jump * step) & ((1 << self.procs[i].width) - 1)
+            self.changed.add(reg)
+        self.propagate()
+        self.cycle += jump
+        self.skipped += jump
+        self.dirty = set(i for i, _, _ in states)
+
+    def step(self):
+        updates = []
+        for i in self.dirty:
+            value = self.next_state[i](self.values)
+            if value != self.values[self.ff_ids[i]]:
+                updates.append((self.ff_ids[i], value))
+        self.dirty = set()
+
+        for net, value in updates:
+            self._update(net, value)
+        self.propagate()
+        self.cycle += 1
+
+    def run(self, cycles, stimulus=None, skip=True):
+        stimulus = stimulus or {}
+        events = sorted(x for x in stimulus if x >= self.cycle)
+        end = self.cycle + cycles
+
+        while self.cycle < end:
+            for net, value in stimulus.get(self.cycle, {}).items():
+                self.set(net, value)
+            self.propagate()
+
+            if skip:
+                while events and events[0] <= self.cycle:
+                    events.pop(0)
+                limit = min(end, events[0] if events else end) - self.cycle
+                self._skip(limit)
+                if self.cycle >= end:
+                    break
+
+            self.step()
+
+
+def main():
+    from cleanup3 import Cleaner
+
+    parser = argparse.ArgumentParser(description="Simulate the cleaned design and decode a UART output")
+    parser.add_argument("source", nargs="?", default="test.v")
+    parser.add_argument("--names", help="icebox_vlog output to take net names from when loading an .asc")
+    parser.add_argument("--clock", default=None)
+    parser.add_argument("--output", default="flag")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--clock-hz", type=float, default=12e6)
+    parser.add_argument("--cycles", type=int, default=12000000)
+    parser.add_argument("--force", action="append", default=[], help="net=value, e.g. n1297=1")
+    parser.add_argument("--send", default=None, help="Bytes to send as UART on --input")
+    parser.add_argument("--input", default="stim")
+    args = parser.parse_args()
+
+    # Keep stdout for the decoded output
+    with redirect_stdout(sys.stderr):
+        cleaner = Cleaner.load(args.source, args.names)
+        cleaner.pass1()
+        cleaner.pass2()
+        cleaner.pass3()
+        for force in args.force:
+            net, value = force.split("=")
+            cleaner.mod.replace_net(net, value)
+        cleaner.clean()
+
+    sim = Simulator(cleaner.mod, args.clock)
+    decoder = sim.uart(args.output, args.baud, args.clock_hz)
+
+    stimulus = {}
+    if args.send:
+        stimulus = uart_stimulus(args.input, args.send.encode(), args.clock_hz / args.baud, start=1000)
+
+    sim.run(args.cycles, stimulus)
+    decoder.flush(sim.cycle)
+
+    print("%d cycles, %d skipped, %d framing errors" % (sim.cycle, sim.skipped, decoder.errors), file=sys.stderr)
+    print(bytes(decoder.data).decode("ascii", errors="replace"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+module top(input clk, input en, input rst, output [3:0] led);
+    reg [7:0] cnt = 0;
+    always @(posedge clk)
+        if (rst)
+            cnt <= 0;
+        else if (en)
+            cnt <= cnt + 1;
+    assign led = cnt[7:4] ^ cnt[3:0];
+endmodule
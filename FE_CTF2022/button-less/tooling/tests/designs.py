@@ -0,0 +1,97 @@
+import contextlib
+import io
+import random
+
+from cleanup3 import Cleaner
+from module import Module
+
+
+RULES = {"rename": {}, "output": [], "resets": {}, "trace_shifts": [], "invert_ff": [], "align_shifts": [], "bundle_wires": {}}
+
+
+def cleaner(mod, **rules):
+    return Cleaner(mod=mod, rules=dict(RULES, **rules))
+
+
+def counter(width, en="1", style="cin"):
+    # Bit-level counter as icebox_vlog gives it. "cin" chains every bit with a
+    # carry in of 1, "yosys" toggles bit 0 and carries it into bit 1.
+    mod = Module(["clk", "en"], ["tick"])
+    first = 0 if style == "cin" else 1
+    if style == "yosys":
+        mod.add_register("q0", "0")
+        mod.add_clocked("clk", en, "q0", ("!", "q0"))
+    for i in range(first, width):
+        cin = "c%d" % (i - 1) if i > first else ("1" if style == "cin" else "q0")
+        mod.add_assignment("c%d" % i, ("carry", "q%d" % i, "0", cin))
+        mod.add_assignment("s%d" % i, ("^", "q%d" % i, cin) if i else ("!", "q0"))
+        mod.add_register("q%d" % i, "0")
+        mod.add_clocked("clk", en, "q%d" % i, "s%d" % i)
+    mod.add_assignment("tick", ("&",) + tuple("q%d" % i for i in range(width)))
+    return mod
+
+
+def run_pipeline(c, steps=("pass1", "pass2", "pass3")):
+    with contextlib.redirect_stdout(io.StringIO()):
+        for step in steps:
+            getattr(c, step)()
+    return c
+
+
+def random_expr(rng, leaves, depth):
+    if depth == 0 or rng.random() < 0.25:
+        return rng.choice(leaves)
+    op = rng.choice(["?", "!", "&", "|", "^", "&", "|"])
+    if op == "?":
+        return ("?",) + tuple(random_expr(rng, leaves, depth - 1) for _ in range(3))
+    if op == "!":
+        return ("!", random_expr(rng, leaves, depth - 1))
+    return (op,) + tuple(random_expr(rng, leaves, depth - 1) for _ in range(rng.randint(2, 3)))
+
+
+def random_design(seed, **rules):
+    # Random logic, FFs with a reset, a shift chain, a counter and a compare,
+    # with rules for every pass of the default pipeline
+    rng = random.Random(seed)
+    mod = Module(["clk", "a", "b", "c", "d", "rstn"], [])
+    leaves = ["a", "b", "c", "d", "0", "1"]
+    nets = []
+    for i in range(60):
+        expr = random_expr(rng, leaves, 4)
+        if nets and rng.random() < 0.5:
+            expr = (rng.choice(["&", "|", "^"]), expr, rng.choice(nets))
+        net = "n%d" % i
+        mod.add_assignment(net, expr)
+        nets.append(net)
+        leaves.append(net)
+    for i in range(12):
+        q = "q%d" % i
+        mod.add_register(q, rng.choice(["0", "1"]))
+        mod.add_clocked("clk", rng.choice(["1", "a", "n3"]), q, ("&", rng.choice(nets), "rstn"))
+        leaves.append(q)
+
+    prev = "a"
+    for i in range(16):
+        s = "s%d" % i
+        mod.add_register(s, rng.choice(["0", "1"]))
+        mod.add_clocked("clk", "b", s, prev if rng.random() < 0.6 else ("!", prev))
+        prev = s
+
+    for i in range(4):
+        cin = "k%d" % (i - 1) if i else "1"
+        mod.add_assignment("k%d" % i, ("carry", "c%d" % i, "0", cin))
+        mod.add_assignment("f%d" % i, ("fa", "c%d" % i, "0", cin))
+        mod.add_register("c%d" % i, "0")
+        mod.add_clocked("clk", "d", "c%d" % i, "f%d" % i)
+
+    # x + 5 carries out of 3 bits
+    mod.add_assignment("e0", ("carry", "q0", "1", "0"))
+    mod.add_assignment("e1", ("carry", "q1", "0", "e0"))
+    mod.add_assignment("e2", ("carry", "q2", "1", "e1"))
+
+    mod.outputs = [rng.choice(nets) for _ in range(6)] + ["s15", "q3", "c3", "e2"]
+    defaults = dict(rename={"n1": "first"}, output=["n7"], resets={"rstn": "0"},
+                    trace_shifts=["s0"], invert_ff=["q2"], align_shifts=["s15"],
+                    bundle_wires={"bus": ["q0", "q1"]}, scan_strings={"min_chars": 1, "min_length": 4})
+    defaults.update(rules)
+    return cleaner(mod, **defaults)
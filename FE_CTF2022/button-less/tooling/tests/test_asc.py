@@ -0,0 +1,25 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+TOOLS = ["yosys", "nextpnr-ice40", "icebox_vlog"]
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+pytest.importorskip("icebox")
+pytestmark = pytest.mark.skipif(not all(shutil.which(x) for x in TOOLS), reason="needs yosys, nextpnr-ice40 and icebox_vlog")
+
+
+def test_asc_matches_icebox_vlog(tmp_path):
+    # Built here rather than committed, the .asc and icebox_vlog output must
+    # come from the installed icestorm to be worth comparing
+    subprocess.run(["yosys", "-q", "-p", "synth_ice40 -top top -json top.json", os.path.join(HERE, "data", "asc_counter.v")], cwd=tmp_path, check=True)
+    subprocess.run(["nextpnr-ice40", "-q", "--hx1k", "--package", "tq144", "--seed", "1", "--json", "top.json", "--asc", "top.asc"], cwd=tmp_path, check=True)
+    with open(tmp_path / "top.v", "w") as f:
+        subprocess.run(["icebox_vlog", "top.asc"], cwd=tmp_path, check=True, stdout=f)
+
+    result = subprocess.run([sys.executable, os.path.join(os.path.dirname(HERE), "asc.py"), "top.asc", "top.v", "--names", "--cycles", "1000"], cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "format: same" in result.stdout
@@ -0,0 +1,49 @@
+import contextlib
+import io
+import time
+
+import egraph
+from designs import cleaner, random_design, run_pipeline
+from module import Module
+from passes import expand
+
+
+def test_pass3_keeps_egraph_results():
+    # optimize flattens the e-graph's 2 LUT form back into 3 LUTs
+    term = ("^", ("|", "b", ("&", "b", "c"), "d"), ("^", ("|", "b", "e"), "d"), ("?", "a", "c", "e"))
+    assert egraph.lut_cost(term) == 3
+
+    mod = Module(["a", "b", "c", "d", "e"], ["out"])
+    mod.add_assignment("out", term)
+    c = cleaner(mod, egraph={"time_limit": 10.0})
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        c.pass3()
+    assert "egraph out: 3 -> 2 LUT4" in out.getvalue()
+    assert egraph.lut_cost(c.mod.combinatorial["out"]) == 2
+
+
+def test_nothing_optimizes_after_egraph():
+    steps = expand(["pass3"])
+    assert "optimize" not in steps[steps.index("egraph"):]
+
+
+def test_budget_is_for_the_whole_run(monkeypatch):
+    c = random_design(3)
+    run_pipeline(c, ["pass1"])
+    start = time.perf_counter()
+    egraph.optimize_module(c.mod, time_limit=0.2, node_limit=10 ** 9, iter_limit=100)
+    # Per net budgets took 0.2 s for each of the ~60 nets
+    assert time.perf_counter() - start < 1.0
+
+    limits = []
+    optimize = egraph._optimize
+
+    def spy(term, rules, node_limit, deadline, iter_limit):
+        limits.append(node_limit)
+        return optimize(term, rules, node_limit, deadline, iter_limit)
+
+    monkeypatch.setattr(egraph, "_optimize", spy)
+    egraph.optimize_module(c.mod, node_limit=500, time_limit=60, iter_limit=100)
+    assert len(limits) < len(c.mod.combinatorial)
+    assert all(b < a for a, b in zip(limits, limits[1:]))
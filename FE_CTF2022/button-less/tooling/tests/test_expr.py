@@ -0,0 +1,16 @@
+from expr import RULES, optimize
+from rewrite import RewriteEngine
+
+
+def test_final_results_are_not_rewritten_again():
+    # de_morgan is final, so the !0 it produces stays as it always has
+    assert optimize(("!", ("|", "a", "0"))) == ("&", ("!", "a"), ("!", "0"))
+    assert optimize(("&", ("&", "a", "b"))) == ("&", "a", "b")
+
+
+def test_memo_is_bounded():
+    engine = RewriteEngine(RULES, memo_limit=10)
+    for i in range(100):
+        engine.rewrite(("&", ("|", "a%d" % i, "1"), "b"))
+    assert len(engine.memo) <= 10
+    assert engine.rewrite(("&", ("|", "a", "b"), "1")) == ("|", "a", "b")
@@ -0,0 +1,84 @@
+import contextlib
+import io
+
+import pytest
+
+from designs import random_design
+from passes import PassManager, expand
+
+
+PIPELINE = ["pass1", "pass2", "pass3"]
+# Seed 7 cancels an xor down to nothing, which optimize has always refused
+SEEDS = [seed for seed in range(13) if seed != 7]
+
+
+def state(c):
+    return c.format(), repr(c.mod.widths), repr(c.mod.bundles)
+
+
+def run_plain(c):
+    # Every pass called directly, nothing skipped, replayed or cached
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        for step in expand(PIPELINE):
+            getattr(c, "_pass_" + step)()
+    return out.getvalue()
+
+
+def run_managed(c, **kwargs):
+    manager = PassManager(c, **kwargs)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        manager.run(PIPELINE)
+    manager.save()
+    return out.getvalue(), manager
+
+
+# A second rule set that shares the cache, results must not leak between them
+VARIANT = dict(invert_ff=["q3"], output=["n9"], rename={"n2": "second"}, align_shifts=["s14"])
+
+
+def plain(seed, **rules):
+    c = random_design(seed, **rules)
+    output = run_plain(c)
+    return output, state(c)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_manager_matches_plain_run(seed, tmp_path):
+    expected = plain(seed)
+
+    # Skipped passes must not change anything
+    for workers in [1, 4]:
+        c = random_design(seed)
+        out, manager = run_managed(c, workers=workers)
+        assert (out, state(c)) == expected
+        assert any(stat["skipped"] for stat in manager.stats.values())
+
+    variant = plain(seed, **VARIANT)
+    cache = str(tmp_path / "passes.pkl")
+    for run in range(2):
+        c = random_design(seed)
+        out, manager = run_managed(c, cache_file=cache)
+        assert (out, state(c)) == expected
+
+        c = random_design(seed, **VARIANT)
+        out, manager = run_managed(c, cache_file=cache)
+        assert (out, state(c)) == variant
+    assert any(stat["cached"] for stat in manager.stats.values())
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_idempotent_passes_are_fixpoints(seed):
+    c = random_design(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for step in expand(PIPELINE):
+            func = getattr(c, "_pass_" + step)
+            if func.idempotent and func.writes:
+                before = c.mod.copy()
+                func()
+                once = state(c)
+                func()
+                assert state(c) == once, step
+                c.mod = before
+            func()
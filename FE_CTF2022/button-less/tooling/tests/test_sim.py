@@ -0,0 +1,43 @@
+import pytest
+
+from designs import cleaner, counter, run_pipeline
+from module import Module
+from sim import Simulator
+
+
+def ticks(mod, cycles, stimulus=None, skip=True):
+    sim = Simulator(mod.copy(), "clk")
+    sim.set("en", 1)
+    seen = []
+    sim.watch("tick", lambda cycle, value: seen.append((cycle, value)))
+    sim.run(cycles, stimulus, skip=skip)
+    return sim, seen
+
+
+@pytest.mark.parametrize("style", ["cin", "yosys"])
+@pytest.mark.parametrize("en", ["1", "en"])
+def test_recovered_counter_is_skipped(style, en):
+    c = run_pipeline(cleaner(counter(10, en, style)))
+    assert [proc.dest for proc in c.mod.clocked] == ["cnt_q0"]
+
+    sim, seen = ticks(c.mod, 100000)
+    assert sim.counters
+    assert sim.skipped > 0
+    assert seen == ticks(c.mod, 100000, skip=False)[1]
+    assert seen == ticks(counter(10, en, style), 100000, skip=False)[1]
+
+
+def test_carry_in_counter_is_skipped():
+    mod = Module(["clk", "en"], ["tick"])
+    mod.add_register("cnt", "0")
+    mod.add_clocked("clk", "1", "cnt", ("+", "cnt", "10'd0", "en"))
+    mod.clocked[0].width = 10
+    mod.clocked[0].reset_value = "10'd0"
+    mod.clocked[0].init = "10'd0"
+    mod.add_assignment("tick", ("==", "cnt", "10'd1000"))
+
+    stimulus = {0: {"en": 1}, 2500: {"en": 0}, 3000: {"en": 1}}
+    sim, seen = ticks(mod, 5000, stimulus)
+    assert sim.skipped > 0
+    assert seen == ticks(mod, 5000, stimulus, skip=False)[1]
+    assert seen[:2] == [(999, 1), (1000, 0)]